@@ -1,4 +1,5 @@
 import contextlib
+import itertools
 import random
 import selectors
 import socket
@@ -18,6 +19,9 @@ SERVER_PORT_BASE = 9990
 # The timeout for a response to arrive when asking for help
 RESP_TIMEOUT_SECONDS = 3
 
+# In datagram (UDP) mode, time after which unanswered requests are sent again
+RETRANSMIT_INTERVAL_SECONDS = 0.5
+
 #############################
 #  CONFIGURATION FUNCTIONS  #
 #############################
@@ -29,6 +33,18 @@ def min_accepted_help_req_num(num_helpers):
 # Check the case of 3 helpers (what the instructions say)
 assert min_accepted_help_req_num(3) == 2
 
+def print_responses(responses):
+    print(f"Got {len(responses)} responses:")
+    for helper, data in responses.items():
+        print(f"[{helper}]:\t{data}")
+
+def enough_ok_responses(responses, num_helpers):
+    num_ok_responses = 0
+    for _, data in responses.items():
+        if data == "ok!":
+            num_ok_responses += 1
+    return num_ok_responses >= min_accepted_help_req_num(num_helpers)
+
 class Client:
     def __init__(self, hosts_ports):
         # Create a socket (SOCK_STREAM means a TCP socket)
@@ -63,11 +79,7 @@ class Client:
                 sock = key.fileobj
                 responses.update({sock: callback(sock)})
             # Check if we have enough ok responses
-            num_ok_responses = 0
-            for _, data in responses.items():
-                if data == "ok!":
-                    num_ok_responses += 1
-            if num_ok_responses >= min_accepted_help_req_num(len(self.sockets)):
+            if enough_ok_responses(responses, len(self.sockets)):
                 got_help = True
                 break
             # All responses acquired, no need to wait any further
@@ -76,36 +88,107 @@ class Client:
             curr_time = time.monotonic()
             if curr_time - init_time > RESP_TIMEOUT_SECONDS:
                 break
-        print(f"Got {len(responses)} responses:")
-        for sock, data in responses.items():
-            print(f"[{sock}]:\t{data}")
+        print_responses(responses)
         return got_help
 
+    def ask_for_help(self):
+        with selectors.DefaultSelector() as sel:
+            for sock, _ in self.sockets.items():
+                sock.sendall("help!".encode("utf-8"))
+                sel.register(sock, selectors.EVENT_READ, self.handle_response)
+            print()
+            print("Asking for help!")
+            return self.get_responses(sel)
+
     def main_loop(self):
         while True:
-            with selectors.DefaultSelector() as sel:
-                for sock, _ in self.sockets.items():
-                    sock.sendall("help!".encode("utf-8"))
-                    sel.register(sock, selectors.EVENT_READ, self.handle_response)
-                print()
-                print("Asking for help!")
-                got_help = self.get_responses(sel)
-                # Log result of getting responses
-                print()
-                if got_help:
-                    print("Got enough help!!!")
-                    return
-                print("Did not receive enough help...")
-                print()
-                print("Zzzzz...")
-                time.sleep(random.randint(1, 1)) # Range changed for convenience of testing
-                print()
-                print()
+            got_help = self.ask_for_help()
+            # Log result of getting responses
+            print()
+            if got_help:
+                print("Got enough help!!!")
+                return
+            print("Did not receive enough help...")
+            print()
+            print("Zzzzz...")
+            time.sleep(random.randint(1, 1)) # Range changed for convenience of testing
+            print()
+            print()
+
+# Connection-free variant of the client, where a single UDP socket talks
+# to every helper. Requests carry an ID so that answers to old requests
+# can be told apart, and requests without an answer are retransmitted.
+class DatagramClient(Client):
+    def __init__(self, hosts_ports):
+        # Create a socket (SOCK_DGRAM means a UDP socket)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # Answers come from the resolved address, not from the host name
+        self.helpers = [(socket.gethostbyname(host), port) for host, port in hosts_ports]
+        self.request_ids = itertools.count(random.randrange(2**31))
+
+    def __enter__(self):
+        self.sock.__enter__()
+        print(f"Ready to ask {len(self.helpers)} helpers over UDP!")
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.sock.close()
+        self.sock.__exit__(exc_type, exc_val, exc_tb)
+
+    def send_requests(self, request, responses):
+        for helper in self.helpers:
+            if helper not in responses:
+                self.sock.sendto(request, helper)
+
+    # Handle data from server, returns None for stale or unknown answers
+    def handle_datagram(self, request_id):
+        data, addr = self.sock.recvfrom(1024)
+        response, _, response_id = data.decode("utf-8").rstrip().partition(" ")
+        if response_id != request_id or addr not in self.helpers:
+            return None, None
+        return addr, response
+
+    def ask_for_help(self):
+        request_id = str(next(self.request_ids))
+        request = f"help! {request_id}".encode("utf-8")
+        print()
+        print(f"Asking for help! (request {request_id})")
+        init_time = time.monotonic()
+        next_send_time = init_time
+        responses = {}
+        got_help = False
+        with selectors.DefaultSelector() as sel:
+            sel.register(self.sock, selectors.EVENT_READ)
+            while True:
+                curr_time = time.monotonic()
+                if curr_time - init_time > RESP_TIMEOUT_SECONDS:
+                    break
+                if curr_time >= next_send_time:
+                    self.send_requests(request, responses)
+                    next_send_time = curr_time + RETRANSMIT_INTERVAL_SECONDS
+                remaining = RESP_TIMEOUT_SECONDS - (curr_time - init_time)
+                if sel.select(min(remaining, next_send_time - curr_time)):
+                    helper, data = self.handle_datagram(request_id)
+                    # Duplicated answers are only counted once
+                    if helper is not None and helper not in responses:
+                        responses[helper] = data
+                # Check if we have enough ok responses
+                if enough_ok_responses(responses, len(self.helpers)):
+                    got_help = True
+                    break
+                # All responses acquired, no need to wait any further
+                if len(responses) == len(self.helpers):
+                    break
+        print_responses(responses)
+        return got_help
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print(f"usage: {sys.argv[0]} <ID>")
+    udp = "--udp" in sys.argv[1:]
+    ids = [arg for arg in sys.argv[1:] if arg != "--udp"]
+    if len(ids) < 1:
+        print(f"usage: {sys.argv[0]} [--udp] <ID> [<ID> ...]")
     else:
-        with Client([(SERVER_HOST, SERVER_PORT_BASE + int(port)) for port in sys.argv[1:]]) as client:
+        client_class = DatagramClient if udp else Client
+        with client_class([(SERVER_HOST, SERVER_PORT_BASE + int(port)) for port in ids]) as client:
             client.main_loop()
         print("Byeeeee!")
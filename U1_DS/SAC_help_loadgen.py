@@ -0,0 +1,177 @@
+import argparse
+import asyncio
+import bisect
+import math
+import statistics
+import time
+
+from SAC_help_client import SERVER_HOST, SERVER_PORT_BASE, RESP_TIMEOUT_SECONDS, min_accepted_help_req_num
+from SAC_help_server import parse_helper_ids
+
+#############################
+#  CONFIGURATION CONSTANTS  #
+#############################
+
+# Default number of simulated clients running at the same time
+DEFAULT_NUM_CLIENTS = 1000
+
+# Default number of help rounds each simulated client performs
+DEFAULT_ROUNDS_PER_CLIENT = 5
+
+# Maximum number of connections being opened at the same time,
+# so that the helpers' listen backlogs do not overflow
+MAX_PENDING_CONNECTS = 256
+
+# Upper bounds (in seconds) of the latency histogram buckets
+LATENCY_BUCKETS = [0.1, 0.25, 0.5, 1.0, 1.5, 2.0, 2.5, 3.0, math.inf]
+
+# Percentiles reported for the time to reach quorum, from 1 to 99
+QUORUM_PERCENTILES = [50, 90, 95, 99]
+
+#############################
+#     STATS COLLECTION      #
+#############################
+
+class HelperStats:
+    def __init__(self):
+        self.bucket_counts = [0] * len(LATENCY_BUCKETS)
+        self.num_ok = 0
+        self.num_no = 0
+        self.num_missing = 0
+
+    def record_response(self, latency, response):
+        self.bucket_counts[bisect.bisect_left(LATENCY_BUCKETS, latency)] += 1
+        if response == "ok!":
+            self.num_ok += 1
+        else:
+            self.num_no += 1
+
+class LoadStats:
+    def __init__(self, host_ports):
+        self.helpers = {host_port: HelperStats() for host_port in host_ports}
+        self.num_rounds = 0
+        self.num_successful_rounds = 0
+        self.quorum_times = []
+        self.failed_clients = 0
+
+    def record_round(self, quorum_time):
+        self.num_rounds += 1
+        if quorum_time is not None:
+            self.num_successful_rounds += 1
+            self.quorum_times.append(quorum_time)
+
+def print_report(stats, elapsed):
+    quorum_times = sorted(stats.quorum_times)
+    print()
+    print(f"Rounds:          {stats.num_rounds} in {elapsed:.2f} s")
+    print(f"Rounds/sec:      {stats.num_rounds / elapsed:.2f}")
+    if stats.num_rounds:
+        ratio = stats.num_successful_rounds / stats.num_rounds
+        print(f"Success ratio:   {ratio:.3f} (quorum of {min_accepted_help_req_num(len(stats.helpers))}/{len(stats.helpers)})")
+    if stats.failed_clients:
+        print(f"Failed clients:  {stats.failed_clients}")
+    print("Time to quorum:")
+    if quorum_times:
+        # Cut points of percentiles 1 to 99, which need two times at least
+        cut_points = statistics.quantiles(quorum_times, n = 100, method = "inclusive") if len(quorum_times) > 1 else quorum_times * 99
+        for pct in QUORUM_PERCENTILES:
+            print(f"    p{pct}:\t{cut_points[pct - 1] * 1000:.1f} ms")
+        print(f"    max:\t{quorum_times[-1] * 1000:.1f} ms")
+    for (host, port), helper in stats.helpers.items():
+        total = max(sum(helper.bucket_counts), 1)
+        print()
+        print(f"Helper '{host}:{port}': {helper.num_ok} ok, {helper.num_no} no, {helper.num_missing} missing")
+        for bound, count in zip(LATENCY_BUCKETS, helper.bucket_counts):
+            label = f"<= {bound:.2f} s" if bound != math.inf else "> %.2f s"%LATENCY_BUCKETS[-2]
+            print(f"    {label:>10}  {count:>8}  {'#' * round(40 * count / total)}")
+
+#############################
+#    SIMULATED  CLIENTS     #
+#############################
+
+# Behaves like `Client` from `SAC_help_client`, except for waiting on
+# all helpers even after reaching quorum, so that late answers do not
+# get mistaken for the answers to the next round. For the same reason,
+# connections to helpers which did not answer in time are reopened.
+class SimulatedClient:
+    def __init__(self, host_ports, stats, connect_sem):
+        self.host_ports = host_ports
+        self.stats = stats
+        self.connect_sem = connect_sem
+        self.streams = {}
+
+    async def __aenter__(self):
+        async with self.connect_sem:
+            for host_port in self.host_ports:
+                self.streams[host_port] = await asyncio.open_connection(*host_port)
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        for _, writer in self.streams.values():
+            writer.close()
+
+    async def reconnect(self, host_port):
+        self.streams[host_port][1].close()
+        async with self.connect_sem:
+            self.streams[host_port] = await asyncio.open_connection(*host_port)
+
+    async def ask_helper(self, host_port, init_time, quorum):
+        reader, writer = self.streams[host_port]
+        writer.write("help!".encode("utf-8"))
+        data = await reader.read(1024)
+        if not data:
+            raise ConnectionError(f"Helper '{host_port[0]}:{host_port[1]}' disconnected")
+        response = data.decode("utf-8").rstrip()
+        self.stats.helpers[host_port].record_response(time.monotonic() - init_time, response)
+        if response == "ok!":
+            quorum.append(time.monotonic() - init_time)
+
+    async def help_round(self):
+        init_time = time.monotonic()
+        quorum = []
+        tasks = {host_port: asyncio.create_task(self.ask_helper(host_port, init_time, quorum)) for host_port in self.host_ports}
+        done, pending = await asyncio.wait(tasks.values(), timeout = RESP_TIMEOUT_SECONDS)
+        for host_port, task in tasks.items():
+            if task in pending:
+                task.cancel()
+                self.stats.helpers[host_port].num_missing += 1
+        # Only once every task is accounted for, as retrieving
+        # their exceptions also keeps asyncio from logging them
+        errors = [task.exception() for task in done if task.exception() is not None]
+        if errors:
+            raise errors[0]
+        # Answers get recorded in arrival order, so the quorum
+        # was reached when the last required answer arrived
+        needed = min_accepted_help_req_num(len(self.host_ports))
+        self.stats.record_round(quorum[needed - 1] if len(quorum) >= needed else None)
+        for host_port, task in tasks.items():
+            if task in pending:
+                await self.reconnect(host_port)
+
+    async def run(self, num_rounds):
+        try:
+            async with self:
+                for _ in range(num_rounds):
+                    await self.help_round()
+        except OSError:
+            self.stats.failed_clients += 1
+
+async def generate_load(host_ports, num_clients, num_rounds):
+    stats = LoadStats(host_ports)
+    connect_sem = asyncio.Semaphore(MAX_PENDING_CONNECTS)
+    clients = [SimulatedClient(host_ports, stats, connect_sem) for _ in range(num_clients)]
+    init_time = time.monotonic()
+    await asyncio.gather(*(client.run(num_rounds) for client in clients))
+    return stats, time.monotonic() - init_time
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Measure how many help rounds per second a set of helpers sustains")
+    parser.add_argument("helper_ids", metavar = "<ID>[-<ID>]", nargs = "+", help = "helper IDs, ranges are inclusive")
+    parser.add_argument("-c", "--clients", type = int, default = DEFAULT_NUM_CLIENTS, help = "number of concurrent clients")
+    parser.add_argument("-r", "--rounds", type = int, default = DEFAULT_ROUNDS_PER_CLIENT, help = "help rounds per client")
+    parser.add_argument("--host", default = SERVER_HOST, help = "host the helpers run on")
+    args = parser.parse_args()
+    host_ports = [(args.host, SERVER_PORT_BASE + helper_id) for helper_id in parse_helper_ids(args.helper_ids)]
+    print(f"Running {args.clients} clients x {args.rounds} rounds against {len(host_ports)} helpers...")
+    stats, elapsed = asyncio.run(generate_load(host_ports, args.clients, args.rounds))
+    print_report(stats, elapsed)
@@ -1,4 +1,9 @@
 import builtins
+import collections
+import errno
+import functools
+import heapq
+import itertools
 import random
 import selectors
 import socket
@@ -8,6 +13,12 @@ import threading
 import time
 import warnings
 
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, where the limit cannot be raised anyway
+    resource = None
+
 #############################
 #  CONFIGURATION CONSTANTS  #
 #############################
@@ -19,15 +30,68 @@ SERVER_HOST = ""
 # Port base to use, note that an index is added to this
 SERVER_PORT_BASE = 9990
 
+# Backlog of pending connections for each listening socket
+# when hosting several helper IDs in the same process
+LISTEN_BACKLOG = 128
+
+# Number of answered datagram requests each helper remembers, so
+# that retransmissions get the same answer instead of a new one
+REPLY_CACHE_SIZE = 4096
+
+# Time to stop accepting connections for after running out of
+# file descriptors, instead of failing to accept them in a loop
+ACCEPT_RETRY_SECONDS = 0.1
+
+#############################
+#  CONFIGURATION FUNCTIONS  #
+#############################
+
+# Decision policies for specific helper IDs, e.g. to make some
+# helpers always refuse: `{3: DecisionPolicy(ok_chance = 0)}`
+HELPER_POLICY_OVERRIDES = {}
+
+# The decision policy used by the helper with the given ID
+def cf_get_decision_policy(helper_id):
+    return HELPER_POLICY_OVERRIDES.get(helper_id, DecisionPolicy())
+
 # Override print function to show the thread it's running on
 def print(*args):
     thread_name = threading.current_thread().name.split()[0]
     builtins.print(("[%s] "%thread_name).ljust(20) + " ".join(map(str, args)))
 
+class DecisionPolicy:
+    # The default values are the ones of the original helper: 40% chance
+    # to accept, 10% chance to never answer and 1 or 2 seconds to think
+    def __init__(self, ok_chance = 0.4, no_response_chance = 0.1, min_delay = 1, max_delay = 2):
+        assert ok_chance + no_response_chance <= 1
+        self.ok_chance = ok_chance
+        self.no_response_chance = no_response_chance
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+
+    def delay(self):
+        return random.randint(self.min_delay, self.max_delay)
+
+    def decide(self):
+        value = random.random()
+        if value < self.no_response_chance:
+            return None
+        elif value < self.no_response_chance + self.ok_chance:
+            return "ok!"
+        else:
+            return "no!"
+
+def log_response(response, prefix = ""):
+    if response is None:
+        print(prefix + "Responding ---> [timed out: analysis paralysis]")
+    else:
+        print(prefix + "Responding ---> " + response)
+
 class Helper:
-    def __init__(self, addr, client_sock):
+    def __init__(self, addr, client_sock, policy):
         self.addr = addr
         self.client_sock = client_sock
+        self.policy = policy
 
     def __enter__(self):
         print("Connected " + self.addr)
@@ -38,16 +102,9 @@ class Helper:
         print("Disconnected " + self.addr)
 
     def decide_response(self):
-        value = random.randint(1, 10)
-        if value == 10:
-            print("Responding ---> [timed out: analysis paralysis]")
-            return None
-        elif value <= 4:
-            print("Responding ---> ok!")
-            return "ok!"
-        else:
-            print("Responding ---> no!")
-            return "no!"
+        response = self.policy.decide()
+        log_response(response)
+        return response
 
     def handle_sock(self, sock):
         data = sock.recv(1024).decode("utf-8").rstrip()
@@ -56,7 +113,7 @@ class Helper:
             return True
         print("Data received: %s"%data)
         if data == "help!":
-            time.sleep(random.randint(1, 2))
+            time.sleep(self.policy.delay())
             response = self.decide_response()
             if response is not None:
                 sock.sendall(response.encode("utf-8"))
@@ -82,7 +139,7 @@ class HelperHandler(socketserver.BaseRequestHandler):
     # this method gets executed in a dedicated thread.
     def handle(self):
         # We use a context manager to easily release resources on exit
-        with Helper(str(self.client_address), self.request) as helper:
+        with Helper(str(self.client_address), self.request, self.server.helper_policy) as helper:
             helper.serve_requests_forever()
 
 # Server which spawns a new thread for each connection
@@ -90,13 +147,232 @@ class ThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
     daemon_threads = True
     allow_reuse_address = True
 
+    def __init__(self, server_address, handler_class, helper_policy):
+        super().__init__(server_address, handler_class)
+        self.helper_policy = helper_policy
+
+#############################
+#  MULTI-ID HELPER HOSTING  #
+#############################
+
+# Spawning one interpreter per helper ID gets expensive quickly, so
+# many helper IDs can be hosted by a single thread instead. As there
+# is no thread to put to sleep, thinking delays become timers which
+# are run by the selector loop once they expire.
+#
+# In datagram (UDP) mode, requests look like `help! <request ID>` and
+# answers like `ok! <request ID>`. Clients retransmit requests which
+# were not answered, so every helper keeps track of the requests it
+# has seen to avoid deciding twice on the same request.
+
+# Marker for datagram requests whose answer is still being thought
+PENDING_REPLY = object()
+
+class HelperConnection:
+    def __init__(self, helper_id, addr, sock):
+        self.helper_id = helper_id
+        self.addr = addr
+        self.sock = sock
+        self.closed = False
+
+class MultiHelperHost:
+    def __init__(self, helper_ids, udp = False):
+        self.udp = udp
+        self.policies = {helper_id: cf_get_decision_policy(helper_id) for helper_id in helper_ids}
+        # Answers to datagram requests, keyed by (address, request ID)
+        self.replies = {helper_id: collections.OrderedDict() for helper_id in helper_ids}
+        self.sel = selectors.DefaultSelector()
+        # Heap of (deadline, tie breaker, callback)
+        self.timers = []
+        self.timer_counter = itertools.count()
+
+    def __enter__(self):
+        for helper_id in self.policies:
+            port = SERVER_PORT_BASE + helper_id
+            if self.udp:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                sock.bind((SERVER_HOST, port))
+                sock.setblocking(False)
+                self.sel.register(sock, selectors.EVENT_READ, functools.partial(self.handle_datagram, helper_id))
+            else:
+                listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                listener.bind((SERVER_HOST, port))
+                listener.listen(LISTEN_BACKLOG)
+                listener.setblocking(False)
+                self.sel.register(listener, selectors.EVENT_READ, functools.partial(self.accept_conn, helper_id))
+        print(f"Hosting {len(self.policies)} {'UDP' if self.udp else 'TCP'} helpers on '{SERVER_HOST}'")
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        for key in list(self.sel.get_map().values()):
+            key.fileobj.close()
+        self.sel.close()
+
+    def call_later(self, delay, callback):
+        heapq.heappush(self.timers, (time.monotonic() + delay, next(self.timer_counter), callback))
+
+    def run_expired_timers(self):
+        now = time.monotonic()
+        while self.timers and self.timers[0][0] <= now:
+            _, _, callback = heapq.heappop(self.timers)
+            callback()
+
+    def next_timeout(self):
+        if not self.timers:
+            return None
+        return max(0, self.timers[0][0] - time.monotonic())
+
+    def accept_conn(self, helper_id, listener):
+        try:
+            client_sock, addr = listener.accept()
+        except BlockingIOError:
+            return
+        except OSError as e:
+            # Every helper shares this loop, so failing to accept one
+            # connection must not stop the others from being served
+            print(f"[helper {helper_id}] Could not accept connection: {e!r}")
+            if e.errno in (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM):
+                # The connection stays pending, so wait until some
+                # descriptors have been released before trying again
+                self.sel.unregister(listener)
+                self.call_later(ACCEPT_RETRY_SECONDS, functools.partial(self.resume_accepting, helper_id, listener))
+            return
+        client_sock.setblocking(False)
+        conn = HelperConnection(helper_id, str(addr), client_sock)
+        print(f"[helper {helper_id}] Connected {conn.addr}")
+        self.sel.register(client_sock, selectors.EVENT_READ, functools.partial(self.handle_conn, conn))
+
+    def resume_accepting(self, helper_id, listener):
+        self.sel.register(listener, selectors.EVENT_READ, functools.partial(self.accept_conn, helper_id))
+
+    def close_conn(self, conn):
+        conn.closed = True
+        self.sel.unregister(conn.sock)
+        conn.sock.close()
+        print(f"[helper {conn.helper_id}] Disconnected {conn.addr}")
+
+    def handle_conn(self, conn, sock):
+        # Every helper shares this loop, so whatever goes wrong with one
+        # connection must only close that connection
+        try:
+            try:
+                data = sock.recv(1024)
+            except BlockingIOError:
+                return
+            except OSError:
+                data = b""
+            data = data.decode("utf-8", "replace").rstrip()
+            # Empty response means connection broke
+            if not data:
+                self.close_conn(conn)
+                return
+            print(f"[helper {conn.helper_id}] Data received: {data}")
+            if data == "help!":
+                policy = self.policies[conn.helper_id]
+                self.call_later(policy.delay(), functools.partial(self.send_response, conn, policy.decide()))
+        except Exception as e:
+            print(f"[helper {conn.helper_id}] Dropping {conn.addr}: {e!r}")
+            if not conn.closed:
+                self.close_conn(conn)
+
+    def send_response(self, conn, response):
+        # The client may have left while we were thinking
+        if conn.closed:
+            return
+        log_response(response, f"[helper {conn.helper_id}] ")
+        if response is not None:
+            try:
+                conn.sock.sendall(response.encode("utf-8"))
+            except OSError:
+                self.close_conn(conn)
+
+    def handle_datagram(self, helper_id, sock):
+        try:
+            data, addr = sock.recvfrom(1024)
+        except (BlockingIOError, ConnectionError):
+            return
+        request, _, request_id = data.decode("utf-8", "replace").rstrip().partition(" ")
+        if request != "help!" or not request_id:
+            return
+        replies = self.replies[helper_id]
+        key = (addr, request_id)
+        reply = replies.get(key)
+        if reply is PENDING_REPLY:
+            # Still thinking, the answer will be sent eventually
+            return
+        elif key in replies:
+            # Duplicate request, repeat the answer we already gave
+            if reply is not None:
+                sock.sendto(f"{reply} {request_id}".encode("utf-8"), addr)
+            return
+        print(f"[helper {helper_id}] Request {request_id} received from {addr}")
+        replies[key] = PENDING_REPLY
+        if len(replies) > REPLY_CACHE_SIZE:
+            replies.popitem(last = False)
+        policy = self.policies[helper_id]
+        self.call_later(policy.delay(), functools.partial(self.send_datagram_reply, helper_id, sock, key, policy.decide()))
+
+    def send_datagram_reply(self, helper_id, sock, key, response):
+        addr, request_id = key
+        self.replies[helper_id][key] = response
+        log_response(response, f"[helper {helper_id}] ")
+        if response is not None:
+            try:
+                sock.sendto(f"{response} {request_id}".encode("utf-8"), addr)
+            except OSError:
+                # Datagrams are best effort, the client will retransmit
+                pass
+
+    def serve_forever(self):
+        while True:
+            events = self.sel.select(self.next_timeout())
+            # Ignore event masks
+            for key, _ in events:
+                callback = key.data
+                callback(key.fileobj)
+            self.run_expired_timers()
+
+# Every connection to every hosted helper takes a file descriptor, and
+# the usual soft limit of 1024 is easily reached by the load generator
+def raise_open_file_limit():
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            soft = hard
+        except (ValueError, OSError):
+            pass
+    print(f"Open file limit: {soft}")
+
+# Parse helper IDs, where ranges like `0-99` are inclusive
+def parse_helper_ids(args):
+    helper_ids = []
+    for arg in args:
+        first, _, last = arg.partition("-")
+        helper_ids.extend(range(int(first), int(last or first) + 1))
+    return sorted(set(helper_ids))
+
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print(f"usage: {sys.argv[0]} <ID>")
+    udp = "--udp" in sys.argv[1:]
+    args = [arg for arg in sys.argv[1:] if arg != "--udp"]
+    if len(args) < 1:
+        print(f"usage: {sys.argv[0]} [--udp] <ID>[-<ID>] [<ID>[-<ID>] ...]")
     else:
-        port = SERVER_PORT_BASE + int(sys.argv[1])
-        print(f"Starting server on '{SERVER_HOST}:{port}'...")
-        with ThreadedTCPServer((SERVER_HOST, port), HelperHandler) as server:
-            print("Server ready!")
-            server.serve_forever()
+        helper_ids = parse_helper_ids(args)
+        if len(helper_ids) == 1 and not udp:
+            port = SERVER_PORT_BASE + helper_ids[0]
+            print(f"Starting server on '{SERVER_HOST}:{port}'...")
+            policy = cf_get_decision_policy(helper_ids[0])
+            with ThreadedTCPServer((SERVER_HOST, port), HelperHandler, policy) as server:
+                print("Server ready!")
+                server.serve_forever()
+        else:
+            raise_open_file_limit()
+            print(f"Starting {len(helper_ids)} helpers on ports {SERVER_PORT_BASE + helper_ids[0]}-{SERVER_PORT_BASE + helper_ids[-1]}...")
+            with MultiHelperHost(helper_ids, udp) as host:
+                print("Server ready!")
+                host.serve_forever()
         print("Byeeeee!")
@@ -0,0 +1,233 @@
+import asyncio
+import io
+import sys
+
+from http import HTTPStatus
+from urllib.parse import parse_qsl, unquote_to_bytes, urlencode
+from werkzeug.wrappers import Request
+
+from server import LONG_POLL_MAX_WAIT_SECONDS, ConsensusPool, app, open_wal
+
+################################
+#       CONFIG CONSTANTS       #
+################################
+
+# Host and port to listen on, empty host means all interfaces
+SERVER_HOST = ""
+SERVER_PORT = 5000
+
+# Backlog of pending connections, voters tend to arrive in bursts
+LISTEN_BACKLOG = 1024
+
+# Largest accepted request head (request line plus headers)
+MAX_REQUEST_HEAD_BYTES = 16 * 1024
+
+# Largest accepted request body
+MAX_REQUEST_BODY_BYTES = 64 * 1024
+
+# Time an idle keep-alive connection is kept open
+KEEP_ALIVE_TIMEOUT_SECONDS = 75
+
+################################
+#       WSGI ADAPTER BITS      #
+################################
+
+# The Flask app already implements the endpoints, including the auth,
+# JSON and precondition decorators, so this server only speaks HTTP on
+# an event loop and calls the app through WSGI. Handlers never block,
+# except for long polls, which get waited on here without any thread.
+
+class BadRequest(Exception):
+    def __init__(self, status_code):
+        super().__init__(status_code.phrase)
+        self.status_code = status_code
+
+def build_environ(method, target, version, headers, body, peername, sockname):
+    path, _, query = target.partition("?")
+    environ = {
+        "REQUEST_METHOD": method,
+        "SCRIPT_NAME": "",
+        # WSGI wants the percent-decoded path as a latin-1 string
+        "PATH_INFO": unquote_to_bytes(path).decode("latin-1"),
+        "QUERY_STRING": query,
+        "SERVER_NAME": str(sockname[0]),
+        "SERVER_PORT": str(sockname[1]),
+        "SERVER_PROTOCOL": version,
+        "REMOTE_ADDR": str(peername[0]),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": "http",
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": False,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+        # Waiting for the write-ahead log must not block the event loop
+        "consensus.defer_durability": True,
+    }
+    for name, value in headers:
+        key = name.upper().replace("-", "_")
+        if key in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            environ[key] = value
+        else:
+            key = "HTTP_" + key
+            # Repeated headers get joined, as CGI does
+            environ[key] = environ[key] + "," + value if key in environ else value
+    return environ
+
+def call_wsgi_app(environ):
+    response = []
+    def start_response(status, response_headers, exc_info = None):
+        response[:] = [status, response_headers]
+    chunks = app(environ, start_response)
+    try:
+        body = b"".join(chunks)
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+    status, response_headers = response
+    return status, response_headers, body
+
+def encode_response(status, response_headers, body, keep_alive):
+    lines = ["HTTP/1.1 " + status]
+    for name, value in response_headers:
+        # Length and connection handling are our business
+        if name.lower() not in ("content-length", "connection"):
+            lines.append(name + ": " + value)
+    lines.append("Content-Length: %d"%len(body))
+    lines.append("Connection: " + ("keep-alive" if keep_alive else "close"))
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body
+
+def error_response(status_code):
+    body = ('{"error":"%s"}'%status_code.phrase).encode("utf-8")
+    headers = [("Content-Type", "application/json")]
+    return encode_response("%d %s"%(status_code, status_code.phrase), headers, body, False)
+
+################################
+#         LONG POLLING         #
+################################
+
+async def wait_for_pool_change(pool, known_versions, timeout):
+    loop = asyncio.get_running_loop()
+    changed = asyncio.Event()
+    # Pools may be changed from other threads, so wake up thread-safely
+    def watcher():
+        loop.call_soon_threadsafe(changed.set)
+    with pool.lock:
+        if pool.version not in known_versions:
+            return
+        pool.add_watcher(watcher)
+        # The app closes the round once it is overdue, see `hold_long_poll()`
+        timeout = min(timeout, pool.seconds_until_round_deadline())
+    try:
+        await asyncio.wait_for(changed.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        with pool.lock:
+            pool.remove_watcher(watcher)
+
+async def hold_long_poll(environ):
+    # Only `/get_votes?wait=<seconds>` waits, and only for known voters.
+    # Everything else goes straight to the app, which also takes care
+    # of replying with the appropriate errors.
+    request = Request(environ)
+    wait = request.args.get("wait", type = float)
+    if request.path != "/get_votes" or wait is None:
+        return
+    authorization = request.authorization
+    if authorization is not None and authorization.type == "basic" and authorization.password is not None:
+        username = authorization.username
+        password = authorization.password
+        pool = ConsensusPool.pool_for_password(password)
+        if pool is not None and pool.check_creds(username, password):
+            known_versions = pool.parse_etag_versions(request.if_none_match) or set()
+            await wait_for_pool_change(pool, known_versions, min(max(wait, 0), LONG_POLL_MAX_WAIT_SECONDS))
+    # The app must never block the event loop, so let it answer right away.
+    # If the pool did not change, it will reply 304 as the wait expired.
+    args = [(k, "0" if k == "wait" else v) for k, v in parse_qsl(environ["QUERY_STRING"], keep_blank_values = True)]
+    environ["QUERY_STRING"] = urlencode(args)
+
+async def wait_until_durable(environ):
+    # The app leaves the sequence number of its last logged change here
+    seq = environ.get("consensus.wal_seq")
+    if seq is None:
+        return True
+    loop = asyncio.get_running_loop()
+    durable = loop.create_future()
+    ConsensusPool.wal.call_when_durable(seq, lambda error : loop.call_soon_threadsafe(durable.set_result, error))
+    # Returns whether the changes made it to the log
+    return await durable is None
+
+################################
+#      CONNECTION HANDLING     #
+################################
+
+async def read_request(reader):
+    try:
+        head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), KEEP_ALIVE_TIMEOUT_SECONDS)
+    except (asyncio.IncompleteReadError, asyncio.TimeoutError):
+        # Connection closed (or left idle) between requests
+        return None
+    except asyncio.LimitOverrunError:
+        raise BadRequest(HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE)
+    request_line, *header_lines = head.decode("latin-1").split("\r\n")[:-2]
+    try:
+        method, target, version = request_line.split(" ")
+        headers = [tuple(v.strip() for v in line.split(":", 1)) for line in header_lines]
+        fields = {name.lower(): value for name, value in headers}
+        content_length = int(fields.get("content-length", 0))
+    except ValueError:
+        raise BadRequest(HTTPStatus.BAD_REQUEST)
+    if "transfer-encoding" in fields:
+        raise BadRequest(HTTPStatus.LENGTH_REQUIRED)
+    if content_length > MAX_REQUEST_BODY_BYTES:
+        raise BadRequest(HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+    body = await reader.readexactly(content_length)
+    keep_alive = fields.get("connection", "").lower() != "close" and version == "HTTP/1.1"
+    return method, target, version, headers, body, keep_alive
+
+async def handle_connection(reader, writer):
+    peername = writer.get_extra_info("peername")
+    sockname = writer.get_extra_info("sockname")
+    try:
+        while True:
+            try:
+                request = await read_request(reader)
+            except BadRequest as e:
+                writer.write(error_response(e.status_code))
+                await writer.drain()
+                return
+            if request is None:
+                return
+            method, target, version, headers, body, keep_alive = request
+            environ = build_environ(method, target, version, headers, body, peername, sockname)
+            await hold_long_poll(environ)
+            status, response_headers, body = call_wsgi_app(environ)
+            if not await wait_until_durable(environ):
+                # Error responses close the connection
+                writer.write(error_response(HTTPStatus.INTERNAL_SERVER_ERROR))
+                await writer.drain()
+                return
+            writer.write(encode_response(status, response_headers, body, keep_alive))
+            await writer.drain()
+            if not keep_alive:
+                return
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+async def serve(host, port):
+    # Restore the pools before any request may look for them
+    open_wal()
+    server = await asyncio.start_server(handle_connection, host or None, port, limit = MAX_REQUEST_HEAD_BYTES, backlog = LISTEN_BACKLOG)
+    print(f"Serving consensus pools on '{host}:{port}'...")
+    async with server:
+        await server.serve_forever()
+
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else SERVER_PORT
+    try:
+        asyncio.run(serve(SERVER_HOST, port))
+    except KeyboardInterrupt:
+        print("Byeeeee!")
@@ -0,0 +1,189 @@
+import argparse
+import json
+import math
+import secrets
+import sys
+import threading
+import time
+
+from collections import Counter
+
+import server
+from metrics import REPORT_PERCENTILES, percentile
+from server import CONSENSUS_POOL_SIZE, ConsensusPool, app
+from wire_format import PACKED_MIMETYPE
+
+################################
+#       CONFIG CONSTANTS       #
+################################
+
+# Default numbers of pools the server holds while being measured
+DEFAULT_POOL_COUNTS = [10, 1000, 100000]
+
+# Default numbers of threads sending requests at the same time
+DEFAULT_THREAD_COUNTS = [1, 4, 16]
+
+# Default time each scenario is measured for
+DEFAULT_DURATION_SECONDS = 2.0
+
+################################
+#        POOL  FIXTURES        #
+################################
+
+# Requests go through Flask's test client, i.e. the whole app (auth,
+# decorators, hooks, metrics) minus the network, so that the numbers
+# mostly reflect `ConsensusPool` itself. Pools are set up by calling it
+# directly, which is much faster than joining them over HTTP.
+
+def populate_pools(num_pools):
+    ConsensusPool.reset()
+    voters = []
+    for _ in range(num_pools * CONSENSUS_POOL_SIZE):
+        username = secrets.token_hex(8)
+        voters.append((username, ConsensusPool._join_any_pool(username)))
+    return voters
+
+def voters_for_thread(voters, thread_index, num_threads):
+    # Threads get disjoint pools when there are enough of them, so that
+    # only the scenarios meant to fail run into failed preconditions
+    pools = [voters[i:i + CONSENSUS_POOL_SIZE] for i in range(0, len(voters), CONSENSUS_POOL_SIZE)]
+    if len(pools) >= num_threads:
+        return [voter for pool in pools[thread_index::num_threads] for voter in pool]
+    return pools[thread_index % len(pools)]
+
+################################
+#          SCENARIOS           #
+################################
+
+# Each scenario takes the test client and a voter, and sends one request.
+# Anything needed to prepare it is done first and is not measured.
+
+def current_etag(username):
+    pool = ConsensusPool.pool_for_username(username)
+    with pool.lock:
+        return pool.calculate_etag()
+
+def join_pool(http, voter):
+    username = secrets.token_hex(8)
+    return lambda : http.post("/join_pool", auth = (username, ""), json = {})
+
+def get_votes_ok(http, voter):
+    return lambda : http.get("/get_votes", auth = voter)
+
+def get_votes_packed(http, voter):
+    return lambda : http.get("/get_votes", auth = voter, headers = {"Accept": PACKED_MIMETYPE})
+
+def get_votes_not_modified(http, voter):
+    condition = {"If-None-Match": current_etag(voter[0])}
+    return lambda : http.get("/get_votes", auth = voter, headers = condition)
+
+def post_vote_ok(http, voter):
+    condition = {"If-Match": current_etag(voter[0])}
+    vote = {voter[0]: secrets.randbelow(25)}
+    return lambda : http.post("/post_vote", auth = voter, headers = condition, json = vote)
+
+def post_vote_precondition_failed(http, voter):
+    condition = {"If-Match": "stale"}
+    vote = {voter[0]: secrets.randbelow(25)}
+    return lambda : http.post("/post_vote", auth = voter, headers = condition, json = vote)
+
+SCENARIOS = {
+    "join_pool": join_pool,
+    "get_votes_200": get_votes_ok,
+    "get_votes_200_packed": get_votes_packed,
+    "get_votes_304": get_votes_not_modified,
+    "post_vote_200": post_vote_ok,
+    "post_vote_412": post_vote_precondition_failed,
+}
+
+# These add pools, so the pools get set up again before each of them
+GROWING_SCENARIOS = {"join_pool"}
+
+################################
+#         MEASUREMENT          #
+################################
+
+def run_worker(scenario, voters, deadline, start, latencies, status_codes):
+    http = app.test_client()
+    start.wait()
+    i = 0
+    while time.perf_counter() < deadline[0]:
+        send = scenario(http, voters[i % len(voters)])
+        i += 1
+        init_time = time.perf_counter()
+        r = send()
+        latencies.append(time.perf_counter() - init_time)
+        status_codes[r.status_code] += 1
+
+def measure(name, voters, num_pools, num_threads, duration):
+    latencies = [[] for _ in range(num_threads)]
+    status_codes = [Counter() for _ in range(num_threads)]
+    start = threading.Barrier(num_threads + 1)
+    # Only set right before the threads get released, once they are ready
+    deadline = [math.inf]
+    threads = [threading.Thread(target = run_worker, args = (
+        SCENARIOS[name], voters_for_thread(voters, i, num_threads), deadline, start, latencies[i], status_codes[i]
+    )) for i in range(num_threads)]
+    for thread in threads:
+        thread.start()
+    init_time = time.perf_counter()
+    deadline[0] = init_time + duration
+    start.wait()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - init_time
+    all_latencies = sorted(latency for thread_latencies in latencies for latency in thread_latencies)
+    all_status_codes = sum(status_codes, Counter())
+    return {
+        "scenario": name,
+        "pools": num_pools,
+        "threads": num_threads,
+        "requests": len(all_latencies),
+        "seconds": elapsed,
+        "requests_per_second": len(all_latencies) / elapsed,
+        "latency_ms": {
+            "mean": sum(all_latencies) / len(all_latencies) * 1000 if all_latencies else math.nan,
+            **{"p%d"%pct: percentile(all_latencies, pct) * 1000 for pct in REPORT_PERCENTILES},
+        },
+        "status_codes": {str(code): count for code, count in sorted(all_status_codes.items())},
+    }
+
+def run_benchmarks(pool_counts, thread_counts, scenarios, duration):
+    results = []
+    for num_pools in pool_counts:
+        print(f"Setting up {num_pools} pools...", file = sys.stderr)
+        voters = populate_pools(num_pools)
+        for num_threads in thread_counts:
+            for name in scenarios:
+                if name in GROWING_SCENARIOS:
+                    voters = populate_pools(num_pools)
+                result = measure(name, voters, num_pools, num_threads, duration)
+                results.append(result)
+                latency = result["latency_ms"]
+                print(f"{name:<20} pools {num_pools:>7}  threads {num_threads:>3}  {result['requests_per_second']:>9.1f} req/s"
+                      f"  p50 {latency['p50']:7.3f} ms  p99 {latency['p99']:7.3f} ms  {result['status_codes']}", file = sys.stderr)
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Benchmark the consensus server endpoints in-process, without any network")
+    parser.add_argument("--pools", type = int, nargs = "+", default = DEFAULT_POOL_COUNTS, help = "numbers of pools to measure with")
+    parser.add_argument("--threads", type = int, nargs = "+", default = DEFAULT_THREAD_COUNTS, help = "numbers of threads to measure with")
+    parser.add_argument("--scenarios", nargs = "+", choices = list(SCENARIOS), default = list(SCENARIOS), help = "scenarios to measure")
+    parser.add_argument("-d", "--duration", type = float, default = DEFAULT_DURATION_SECONDS, help = "seconds each measurement lasts")
+    parser.add_argument("-o", "--output", help = "file to write the JSON results to, instead of stdout")
+    args = parser.parse_args()
+    # Pools get reset between runs, which a write-ahead log would not know
+    server.WAL_DIRECTORY = None
+    results = run_benchmarks(args.pools, args.threads, args.scenarios, args.duration)
+    report = {
+        "pool_size": CONSENSUS_POOL_SIZE,
+        "duration_seconds": args.duration,
+        "python": sys.version.split()[0],
+        "results": results,
+    }
+    if args.output is None:
+        json.dump(report, sys.stdout, indent = 2)
+        print()
+    else:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent = 2)
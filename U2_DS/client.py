@@ -7,11 +7,12 @@ import secrets
 import sys
 import time
 
-from collections import Counter
 from http import HTTPStatus
 from requests import Response
 from wsgiref.handlers import format_date_time
 
+from wire_format import COMPACT_JSON_MIMETYPE, PACKED_MIMETYPE, decode_pool_state
+
 ################################
 #       CONFIG CONSTANTS       #
 ################################
@@ -19,6 +20,13 @@ from wsgiref.handlers import format_date_time
 # Host and port to try to connect to
 HOST_PORT = "localhost:5000"
 
+# How long the server may hold `/get_votes` until the pool changes
+LONG_POLL_WAIT_SECONDS = 20
+
+# Representation of pool states to ask for, see `wire_format.py`. Compact
+# ones only carry what changed, plain JSON is easier to read when debugging.
+POOL_STATE_MIMETYPE = PACKED_MIMETYPE
+
 ################################
 #       CONFIG FUNCTIONS       #
 ################################
@@ -27,9 +35,21 @@ HOST_PORT = "localhost:5000"
 def cf_get_vote_value():
     return random.randrange(25)
 
+# Client delay length, used to back off after a rejected vote
+def cf_client_wait_seconds():
+    return random.weibullvariate(1.0, 5.0) # TODO: Make dynamic, backoff?
+
 # Client delay function
 def cf_client_wait():
-    time.sleep(random.weibullvariate(1.0, 5.0)) # TODO: Make dynamic, backoff?
+    time.sleep(cf_client_wait_seconds())
+
+# Delay before retrying a request the server shed, given its Retry-After.
+# Some jitter keeps shed clients from all coming back at the same time.
+def cf_retry_after_wait_seconds(retry_after):
+    if not retry_after.isdigit():
+        # HTTP dates are not worth the trouble, just back off as usual
+        return cf_client_wait_seconds()
+    return int(retry_after) * random.uniform(1.0, 1.5)
 
 ################################
 #       HELPER FUNCTIONS       #
@@ -54,11 +74,25 @@ def use_endpoints(func):
     # Return decorated function
     return wrapper
 
+def retry_when_shed(func):
+    # Decorator retrying requests the server shed under load, once it says so
+    @functools.wraps(func)
+    def wrapper(url, **kwargs):
+        while True:
+            r = func(url, **kwargs)
+            if r.status_code != HTTPStatus.SERVICE_UNAVAILABLE or "Retry-After" not in r.headers:
+                return r
+            time.sleep(cf_retry_after_wait_seconds(r.headers["Retry-After"]))
+    # Return decorated function
+    return wrapper
+
 @use_endpoints
+@retry_when_shed
 def do_get(url, **kwargs):
     return requests.get(url, **kwargs)
 
 @use_endpoints
+@retry_when_shed
 def do_post(url, **kwargs):
     return requests.post(url, **kwargs)
 
@@ -72,6 +106,12 @@ class Client:
         # TODO: Figure out if values are sane
         self.deferred_vote = None
         self.latest_etag = ""
+        # Our slot in the pool, and the votes of each slot as far as we know
+        self.slot = None
+        self.known_votes = {}
+        # Voting round of the latest pool state, and the last one we voted in
+        self.latest_round = 0
+        self.voted_round = None
 
     def __enter__(self):
         self._join_pool()
@@ -80,6 +120,9 @@ class Client:
     def __exit__(self, exc_type, exc_val, exc_tb):
         pass
 
+    def log(self, *args):
+        print(*args)
+
     def _join_pool(self):
         r = do_post("/join_pool", auth = (self.username, ""), json = {})
         match r:
@@ -87,6 +130,7 @@ class Client:
                 if is_json(headers["Content-Type"]):
                     data = r.json()
                     self.credentials = (self.username, data["password"])
+                    self.slot = data["slot"]
                 else:
                     raise NotImplementedError("Non-JSON response received")
             case Response(status_code = status_code, headers = headers):
@@ -98,74 +142,22 @@ class Client:
                 raise NotImplementedError("Unhandled response")
 
     def get_votes(self):
-        condition = {"If-None-Match": self.latest_etag}
-        r = do_get("/get_votes", auth = self.credentials, headers = condition)
+        # The server answers as soon as the pool differs from the state we
+        # saw last, so this blocks until someone else votes (or times out)
+        headers = {"If-None-Match": self.latest_etag, "Accept": POOL_STATE_MIMETYPE}
+        wait = {"wait": LONG_POLL_WAIT_SECONDS}
+        r = do_get("/get_votes", auth = self.credentials, headers = headers, params = wait)
         match r:
             case Response(status_code = HTTPStatus.NOT_MODIFIED):
                 # If we get a Not Modified, we already know that consensus has
                 # not been reached. We can only retry a vote we were unable to
                 # post in a previous iteration due to e.g. failed precondition.
-                #
-                # TODO: When voting in lockstep, something needs to be done to
-                # prevent deadlocks when consensus is not reached. Either have
-                # the server increment a sequence number (which would make the
-                # ETag change) or let clients vote whenever checking consensus.
+                # The server starts new rounds by itself, so we do not stall.
                 return None, False
-            case Response(status_code = HTTPStatus.OK, headers = headers):
-                if not is_json(headers["Content-Type"]):
-                    raise NotImplementedError("Non-JSON response received")
-                match r.json():
-                    case {
-                        "pool_size": pool_size,
-                        "min_agree": min_agree,
-                        "vote_data": vote_data
-                    }:
-                        self.latest_etag = headers["ETag"]
-                        # Print info for debugging
-                        print("pool size: %d"%pool_size)
-                        print("min agree: %d"%min_agree)
-                        print("vote data: %s\tVote\tSeq"%(" " * 56))
-                        for k, (v, s) in vote_data.items():
-                            print("    %s:\t%s\t%s"%(k, v, s))
-                        print()
-
-                        # Collect votes
-                        votes = [v for v, _ in vote_data.values() if v is not None]
-                        c = Counter(votes)
-                        print(c)
-
-                        # Decide what to do
-                        if len(votes) == 0:
-                            # Pool has no votes, should never happen
-                            return None, True
-
-                        number, count = c.most_common(1)[0]
-                        if count >= min_agree:
-                            # Reached consensus
-                            return number, False
-
-                        (myvote, myseq) = vote_data[self.username];
-                        if myvote is None:
-                            # We did not vote yet
-                            return None, True
-
-                        if self.deferred_vote is not None:
-                            # Could not post last time, we can vote
-                            return None, True
-
-                        seqs = [s for _, s in vote_data.values() if s is not None]
-                        if myseq < max(seqs):
-                            # Our sequence number is trailing behind, we can vote
-                            return None, True
-                        else:
-                            # We should only vote again if others have also voted
-                            # Intended to enforce some sort of soft-lockstep mode
-                            # where clients wait for each other's votes but still
-                            # continue voting as long as there are enough of them
-                            # to eventually reach consensus.
-                            return None, sum(s == myseq for s in seqs) >= min_agree
-                    case _:
-                        raise RuntimeError("Cannot parse server response")
+            case Response(status_code = HTTPStatus.OK):
+                return self.handle_pool_state(r)
+            case Response(status_code = HTTPStatus.GONE):
+                return self.handle_archived_result(r)
             case Response(status_code = status_code, headers = headers):
                 if is_json(headers["Content-Type"]):
                     raise RuntimeError("Unexpected HTTP %d: %s"%(status_code, r.json()["error"]))
@@ -174,29 +166,91 @@ class Client:
             case _:
                 raise NotImplementedError("Got a non-Response")
 
+    # Returns the pool size, minimum agreement, round, votes and decision.
+    # Compact states only hold changes, so merge them first.
+    def parse_pool_state(self, r):
+        content_type = r.headers["Content-Type"]
+        if content_type in (COMPACT_JSON_MIMETYPE, PACKED_MIMETYPE):
+            state = decode_pool_state(content_type, r.content)
+            for slot, vote, seq in state["votes"]:
+                self.known_votes[slot] = (vote, seq)
+            return state["pool_size"], state["min_agree"], state["round"], self.known_votes, state["decision"]
+        if not is_json(content_type):
+            raise NotImplementedError("Non-JSON response received")
+        match r.json():
+            case {
+                "pool_size": pool_size,
+                "min_agree": min_agree,
+                "round": current_round,
+                "vote_data": vote_data,
+                "decision": decision
+            }:
+                return pool_size, min_agree, current_round, vote_data, decision
+            case _:
+                raise RuntimeError("Cannot parse server response")
+
+    # Returns the decision outcome and whether we can vote again
+    def handle_pool_state(self, r):
+        pool_size, min_agree, current_round, vote_data, decision = self.parse_pool_state(r)
+        self.latest_etag = r.headers["ETag"]
+        self.latest_round = current_round
+        # Print info for debugging
+        self.log("pool size: %d"%pool_size)
+        self.log("min agree: %d"%min_agree)
+        self.log("round: %d"%current_round)
+        self.log("vote data: %s\tVote\tSeq"%(" " * 56))
+        for k, (v, s) in vote_data.items():
+            self.log("    %s:\t%s\t%s"%(k, v, s))
+        self.log("decision: %s"%decision)
+        self.log()
+
+        # Decide what to do, the server keeps count of the votes
+        if decision is not None:
+            # Reached consensus
+            return decision, False
+
+        if self.deferred_vote is not None:
+            # Could not post last time, we can vote
+            return None, True
+
+        # The server closes rounds once everyone voted, or after a while,
+        # so we vote once per round and wait for the next one otherwise
+        return None, self.voted_round is None or self.voted_round < current_round
+
+    # Returns the decision of our pool, which the server no longer keeps
+    def handle_archived_result(self, r):
+        decision = r.json()["decision"]
+        if decision is None:
+            raise RuntimeError("Pool evicted before reaching consensus")
+        return decision, False
+
     def choose_vote(self):
         return cf_get_vote_value()
 
     def post_vote(self):
+        # The server replies with the resulting pool state either way,
+        # so a vote costs a single round trip even when rejected
         proposed_vote = self.choose_vote() if self.deferred_vote is None else self.deferred_vote
-        condition = {"If-Match": self.latest_etag}
+        voting_round = self.latest_round
+        headers = {"If-Match": self.latest_etag, "Accept": POOL_STATE_MIMETYPE}
         r = do_post(
-            "/post_vote",
+            "/vote_and_get",
             auth = self.credentials,
-            headers = condition,
+            headers = headers,
             json = {self.username: proposed_vote}
         )
         match r:
             case Response(status_code = HTTPStatus.PRECONDITION_FAILED):
-                print("Vote rejected as information has changed in the meantime")
+                self.log("Vote rejected as information has changed in the meantime")
                 self.deferred_vote = proposed_vote
-            case Response(status_code = HTTPStatus.OK, headers = headers):
-                print("Vote posted successfully")
+                return self.handle_pool_state(r)
+            case Response(status_code = HTTPStatus.OK):
+                self.log("Vote posted successfully")
                 self.deferred_vote = None
-                if is_json(headers["Content-Type"]):
-                    data = r.json()
-                else:
-                    raise NotImplementedError("Non-JSON response received")
+                self.voted_round = voting_round
+                return self.handle_pool_state(r)
+            case Response(status_code = HTTPStatus.GONE):
+                return self.handle_archived_result(r)
             case Response(status_code = status_code, headers = headers):
                 if is_json(headers["Content-Type"]):
                     raise RuntimeError("Unexpected HTTP %d: %s"%(status_code, r.json()["error"]))
@@ -206,18 +260,20 @@ class Client:
                 raise NotImplementedError("Got a non-Response")
 
     def loop(self):
-        while True:
-            # Get the decision outcome and whether we can vote again
-            decision_outcome, can_vote = self.get_votes()
-            # If we reached a consensus, exit
-            if decision_outcome is not None:
-                return decision_outcome
-            # If possible, vote
+        # Get the decision outcome and whether we can vote again
+        decision_outcome, can_vote = self.get_votes()
+        # If we reached a consensus, exit
+        while decision_outcome is None:
             if can_vote or self.deferred_vote is not None:
-                self.post_vote()
-            # If we cannot vote, wait for some time
-            if not can_vote or self.deferred_vote is not None:
-                cf_client_wait()
+                # If possible, vote
+                decision_outcome, can_vote = self.post_vote()
+                # If our vote got rejected, back off for some time
+                if self.deferred_vote is not None:
+                    cf_client_wait()
+            else:
+                # No need to wait otherwise, as `get_votes()` long polls
+                decision_outcome, can_vote = self.get_votes()
+        return decision_outcome
 
 def main():
     with Client() as client:
@@ -0,0 +1,270 @@
+import argparse
+import asyncio
+import base64
+import json
+import math
+import socket
+import subprocess
+import sys
+import time
+
+from http import HTTPStatus
+from requests.structures import CaseInsensitiveDict
+
+import client
+from client import Client, cf_client_wait_seconds, cf_retry_after_wait_seconds, LONG_POLL_WAIT_SECONDS, POOL_STATE_MIMETYPE
+from metrics import REPORT_PERCENTILES, percentile
+
+################################
+#       CONFIG CONSTANTS       #
+################################
+
+# Default number of voters simulated at the same time
+DEFAULT_NUM_VOTERS = 1000
+
+# Most connections opened to the server. Long polling voters hold on
+# to their connection while waiting, so this should not be much lower
+# than the number of voters, or waiting voters will starve the others.
+MAX_CONNECTIONS = 4096
+
+# Time after which voters which did not see a decision give up. Note
+# that a pool which does not get enough members never decides.
+VOTER_TIMEOUT_SECONDS = 120
+
+################################
+#      POOLED HTTP CLIENT      #
+################################
+
+# Just enough of `requests.Response` for `Client.handle_pool_state()`
+class FleetResponse:
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    def json(self):
+        return json.loads(self.content)
+
+# Minimal HTTP/1.1 client reusing keep-alive connections to a single server
+class ConnectionPool:
+    def __init__(self, host, port, max_connections):
+        self.host = host
+        self.port = port
+        self.idle = []
+        self.slots = asyncio.Semaphore(max_connections)
+        self.num_connects = 0
+
+    async def _acquire(self):
+        await self.slots.acquire()
+        if self.idle:
+            return self.idle.pop()
+        try:
+            self.num_connects += 1
+            return await asyncio.open_connection(self.host, self.port)
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def _release(self, conn, reusable):
+        if reusable:
+            self.idle.append(conn)
+        else:
+            conn[1].close()
+        self.slots.release()
+
+    async def request(self, method, endpoint, auth = None, headers = {}, params = {}, json_body = None):
+        target = endpoint + ("?" + "&".join("%s=%s"%kv for kv in params.items()) if params else "")
+        lines = [f"{method} {target} HTTP/1.1", f"Host: {self.host}:{self.port}"]
+        if auth is not None:
+            lines.append("Authorization: Basic " + base64.b64encode(":".join(auth).encode("utf-8")).decode("ascii"))
+        lines.extend(f"{k}: {v}" for k, v in headers.items())
+        body = b""
+        if json_body is not None:
+            body = json.dumps(json_body).encode("utf-8")
+            lines.append("Content-Type: application/json")
+        lines.append("Content-Length: %d"%len(body))
+        data = ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body
+        reader, writer = conn = await self._acquire()
+        reusable = False
+        try:
+            writer.write(data)
+            head = await reader.readuntil(b"\r\n\r\n")
+            status_line, *header_lines = head.decode("latin-1").split("\r\n")[:-2]
+            response_headers = CaseInsensitiveDict(line.split(": ", 1) for line in header_lines)
+            content = await reader.readexactly(int(response_headers.get("Content-Length", 0)))
+            reusable = response_headers.get("Connection", "").lower() != "close"
+            return FleetResponse(int(status_line.split(" ")[1]), response_headers, content)
+        finally:
+            self._release(conn, reusable)
+
+################################
+#         FLEET VOTERS         #
+################################
+
+class FleetStats:
+    def __init__(self):
+        self.join_latencies = []
+        self.consensus_times = []
+        self.requests_per_decision = []
+        self.num_requests = 0
+        self.num_response_bytes = 0
+        self.num_rejected = 0
+        self.num_shed = 0
+        self.num_failed = 0
+        self.num_timed_out = 0
+
+def raise_unexpected(r):
+    raise RuntimeError("Unexpected HTTP %d"%r.status_code)
+
+# Same state machine as `Client`, driven by coroutines over pooled
+# connections. Decisions are taken by `Client.handle_pool_state()`.
+class FleetClient(Client):
+    def __init__(self, http, stats):
+        super().__init__()
+        self.http = http
+        self.stats = stats
+        self.num_requests = 0
+
+    def log(self, *args):
+        pass
+
+    async def request(self, method, endpoint, **kwargs):
+        self.num_requests += 1
+        self.stats.num_requests += 1
+        while True:
+            r = await self.http.request(method, endpoint, **kwargs)
+            self.stats.num_response_bytes += len(r.content)
+            if r.status_code != HTTPStatus.SERVICE_UNAVAILABLE or "Retry-After" not in r.headers:
+                return r
+            # Shed by the server, come back when it says so
+            self.stats.num_shed += 1
+            await asyncio.sleep(cf_retry_after_wait_seconds(r.headers["Retry-After"]))
+
+    async def join_pool(self):
+        r = await self.request("POST", "/join_pool", auth = (self.username, ""), json_body = {})
+        if r.status_code not in (HTTPStatus.OK, HTTPStatus.CREATED):
+            raise_unexpected(r)
+        data = r.json()
+        self.credentials = (self.username, data["password"])
+        self.slot = data["slot"]
+
+    async def get_votes(self):
+        headers = {"If-None-Match": self.latest_etag, "Accept": POOL_STATE_MIMETYPE}
+        wait = {"wait": LONG_POLL_WAIT_SECONDS}
+        r = await self.request("GET", "/get_votes", auth = self.credentials, headers = headers, params = wait)
+        match r.status_code:
+            case HTTPStatus.NOT_MODIFIED:
+                return None, False
+            case HTTPStatus.OK:
+                return self.handle_pool_state(r)
+            case HTTPStatus.GONE:
+                return self.handle_archived_result(r)
+            case _:
+                raise_unexpected(r)
+
+    async def post_vote(self):
+        proposed_vote = self.choose_vote() if self.deferred_vote is None else self.deferred_vote
+        voting_round = self.latest_round
+        headers = {"If-Match": self.latest_etag, "Accept": POOL_STATE_MIMETYPE}
+        r = await self.request("POST", "/vote_and_get", auth = self.credentials, headers = headers, json_body = {self.username: proposed_vote})
+        match r.status_code:
+            case HTTPStatus.PRECONDITION_FAILED:
+                self.stats.num_rejected += 1
+                self.deferred_vote = proposed_vote
+                return self.handle_pool_state(r)
+            case HTTPStatus.OK:
+                self.deferred_vote = None
+                self.voted_round = voting_round
+                return self.handle_pool_state(r)
+            case HTTPStatus.GONE:
+                return self.handle_archived_result(r)
+            case _:
+                raise_unexpected(r)
+
+    async def loop(self):
+        decision_outcome, can_vote = await self.get_votes()
+        while decision_outcome is None:
+            if can_vote or self.deferred_vote is not None:
+                decision_outcome, can_vote = await self.post_vote()
+                if self.deferred_vote is not None:
+                    await asyncio.sleep(cf_client_wait_seconds())
+            else:
+                decision_outcome, can_vote = await self.get_votes()
+        return decision_outcome
+
+    async def run(self):
+        try:
+            init_time = time.monotonic()
+            await self.join_pool()
+            joined_time = time.monotonic()
+            self.stats.join_latencies.append(joined_time - init_time)
+            await asyncio.wait_for(self.loop(), VOTER_TIMEOUT_SECONDS)
+            self.stats.consensus_times.append(time.monotonic() - joined_time)
+            self.stats.requests_per_decision.append(self.num_requests)
+        except asyncio.TimeoutError:
+            self.stats.num_timed_out += 1
+        except (OSError, RuntimeError, asyncio.IncompleteReadError):
+            self.stats.num_failed += 1
+
+################################
+#           REPORTING          #
+################################
+
+def print_distribution(name, values, scale = 1, unit = ""):
+    values = sorted(values)
+    pcts = "  ".join("p%d %8.1f%s"%(pct, percentile(values, pct) * scale, unit) for pct in REPORT_PERCENTILES)
+    mean = sum(values) / len(values) * scale if values else math.nan
+    print(f"{name:<24} mean {mean:8.1f}{unit}  {pcts}")
+
+def print_report(stats, http, num_voters, elapsed):
+    print()
+    print(f"Voters:                  {num_voters} in {elapsed:.2f} s")
+    print(f"Decided:                 {len(stats.consensus_times)}, timed out: {stats.num_timed_out}, failed: {stats.num_failed}")
+    print(f"Requests:                {stats.num_requests} ({stats.num_requests / elapsed:.1f}/s), {stats.num_rejected} votes rejected, {stats.num_shed} shed")
+    print(f"Response body bytes:     {stats.num_response_bytes} ({stats.num_response_bytes / max(stats.num_requests, 1):.1f}/request)")
+    print(f"Connections opened:      {http.num_connects}")
+    print_distribution("Join latency", stats.join_latencies, 1000, " ms")
+    print_distribution("Time to consensus", stats.consensus_times, 1000, " ms")
+    print_distribution("Requests per decision", stats.requests_per_decision)
+
+################################
+#        FLEET  DRIVING        #
+################################
+
+async def run_fleet(host, port, num_voters):
+    http = ConnectionPool(host, port, MAX_CONNECTIONS)
+    stats = FleetStats()
+    voters = [FleetClient(http, stats) for _ in range(num_voters)]
+    init_time = time.monotonic()
+    await asyncio.gather(*(voter.run() for voter in voters))
+    elapsed = time.monotonic() - init_time
+    for reader, writer in http.idle:
+        writer.close()
+    return stats, http, elapsed
+
+def start_local_server(port):
+    # Stand-in server in its own process, so it does not share our event loop
+    server = subprocess.Popen([sys.executable, "async_server.py", str(port)], cwd = sys.path[0], stdout = subprocess.DEVNULL)
+    while server.poll() is None:
+        try:
+            socket.create_connection(("localhost", port)).close()
+            return server
+        except ConnectionRefusedError:
+            time.sleep(0.1)
+    raise RuntimeError("Local server exited with code %d"%server.returncode)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Load test the consensus server with many concurrent voters")
+    parser.add_argument("-n", "--voters", type = int, default = DEFAULT_NUM_VOTERS, help = "number of voters")
+    parser.add_argument("--server", default = client.HOST_PORT, help = "host:port of the server")
+    parser.add_argument("--local", action = "store_true", help = "start a local asyncio server on the given port")
+    args = parser.parse_args()
+    host, _, port = args.server.rpartition(":")
+    server = start_local_server(int(port)) if args.local else None
+    try:
+        print(f"Running {args.voters} voters against '{host}:{port}'...")
+        stats, http, elapsed = asyncio.run(run_fleet(host, int(port), args.voters))
+        print_report(stats, http, args.voters, elapsed)
+    finally:
+        if server is not None:
+            server.terminate()
@@ -0,0 +1,186 @@
+import bisect
+import itertools
+import math
+import threading
+import time
+
+################################
+#        METRIC  TYPES         #
+################################
+
+# Just enough of the Prometheus data model for our own use: counters,
+# histograms and gauges, optionally split by a fixed set of labels, and
+# rendered in the text exposition format. Updates take a lock per metric,
+# which is much cheaper than anything a request does anyway.
+
+# Upper bounds (in seconds) of latency histogram buckets
+LATENCY_BUCKETS_SECONDS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+def format_labels(label_names, label_values, extra = ()):
+    pairs = list(zip(label_names, label_values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join('%s="%s"'%(k, v) for (k, _), v in zip(pairs, escaped)) + "}"
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help_text, label_names = ()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.lock = threading.Lock()
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, label_values, extra, value in self.samples():
+            lines.append(self.name + suffix + format_labels(self.label_names, label_values, extra) + " " + format_value(value))
+        return "\n".join(lines)
+
+class CounterMetric(Metric):
+    kind = "counter"
+
+    def __init__(self, name, help_text, label_names = ()):
+        super().__init__(name, help_text, label_names)
+        # Counters without labels are shown even before being increased
+        self.values = {} if self.label_names else {(): 0}
+
+    def inc(self, *label_values, amount = 1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        for label_values, value in values:
+            yield "_total", label_values, (), value
+
+class HistogramMetric(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, label_names = (), buckets = LATENCY_BUCKETS_SECONDS):
+        super().__init__(name, help_text, label_names)
+        self.buckets = list(buckets) + [math.inf]
+        # Label values -> [bucket counts, sum], counts are not cumulative
+        self.values = {}
+        # Label values -> [counter, times read], see `zero_counter()`
+        self.zero_counters = {}
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(label_values)
+            if entry is None:
+                entry = self.values[label_values] = [[0] * len(self.buckets), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def zero_counter(self, *label_values):
+        # Returns a counter of observations of 0 which are recorded by
+        # calling `next()` on it. The GIL makes that atomic, so very
+        # frequent observations do not all contend for the metric lock.
+        entry = self.zero_counters.get(label_values)
+        if entry is None:
+            with self.lock:
+                entry = self.zero_counters.setdefault(label_values, [itertools.count(), 0])
+        return entry[0]
+
+    def samples(self):
+        with self.lock:
+            values = {k: (list(counts), total) for k, (counts, total) in self.values.items()}
+            for label_values, entry in self.zero_counters.items():
+                # Reading a counter also counts one, which is subtracted
+                zeros = next(entry[0]) - entry[1]
+                entry[1] += 1
+                counts, _ = values.setdefault(label_values, ([0] * len(self.buckets), 0.0))
+                counts[bisect.bisect_left(self.buckets, 0)] += zeros
+            values = sorted(values.items())
+        for label_values, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield "_bucket", label_values, (("le", format_value(bound)),), cumulative
+            yield "_sum", label_values, (), total
+            yield "_count", label_values, (), cumulative
+
+class GaugeMetric(Metric):
+    kind = "gauge"
+
+    # Gauges are read when rendered, from a function returning their value
+    def __init__(self, name, help_text, func):
+        super().__init__(name, help_text)
+        self.func = func
+
+    def samples(self):
+        yield "", (), (), self.func()
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        return "\n".join(metric.render() for metric in self.metrics) + "\n"
+
+################################
+#         PERCENTILES          #
+################################
+
+# Percentiles reported by the fleet and the benchmark
+REPORT_PERCENTILES = [50, 90, 99]
+
+# Nearest-rank percentile of an already sorted list
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return math.nan
+    rank = math.ceil(pct / 100 * len(sorted_values))
+    return sorted_values[max(rank, 1) - 1]
+
+################################
+#         TIMED  LOCKS         #
+################################
+
+# Drop-in replacement for `threading.Lock` recording how long acquiring
+# it had to wait. Uncontended acquisitions are recorded as no wait at all
+# without reading the clock or taking the histogram lock, as every pool
+# lock shares the same histogram. Works with `Condition` too.
+class TimedLock:
+    __slots__ = ("_lock", "histogram", "label_values", "uncontended")
+
+    def __init__(self, histogram, *label_values):
+        self._lock = threading.Lock()
+        self.histogram = histogram
+        self.label_values = label_values
+        self.uncontended = histogram.zero_counter(*label_values)
+
+    def acquire(self, blocking = True, timeout = -1):
+        # Non-blocking attempts are ownership probes (e.g. by `Condition`)
+        if not blocking:
+            return self._lock.acquire(False)
+        if self._lock.acquire(False):
+            next(self.uncontended)
+            return True
+        init_time = time.perf_counter()
+        acquired = self._lock.acquire(True, timeout)
+        self.histogram.observe(time.perf_counter() - init_time, *self.label_values)
+        return acquired
+
+    def release(self):
+        self._lock.release()
+
+    def locked(self):
+        return self._lock.locked()
+
+    __enter__ = acquire
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
@@ -1,15 +1,25 @@
 import functools
+import hashlib
+import hmac
 import json
+import math
+import os
 import secrets
+import struct
 import threading
+import time
 
-from collections import Counter
-from flask import Flask, Response, Request, jsonify, make_response
+from array import array
+from collections import Counter, OrderedDict
+from flask import Flask, Response, Request, g, has_request_context, make_response
 from flask import request as g_request
-from hashlib import sha512
 from http import HTTPStatus
 from werkzeug.datastructures.auth import Authorization
 
+from metrics import CounterMetric, GaugeMetric, HistogramMetric, MetricsRegistry, TimedLock
+from wal import WriteAheadLog, recover as recover_wal
+from wire_format import JSON_MIMETYPE, PACKED_MIMETYPE, POOL_STATE_MIMETYPES, encode_compact_json, encode_packed
+
 ################################
 #       CONFIG CONSTANTS       #
 ################################
@@ -17,6 +27,74 @@ from werkzeug.datastructures.auth import Authorization
 # Number of clients voting in the same consensus pool
 CONSENSUS_POOL_SIZE = 3
 
+# Longest time a `/get_votes?wait=<seconds>` request is held
+# while waiting for the pool to change, whatever was requested
+LONG_POLL_MAX_WAIT_SECONDS = 30
+
+# Time pools that reached consensus are kept around, so
+# that all of their members get a chance to see the result
+POOL_DECIDED_TTL_SECONDS = 60
+
+# Longest time a voting round lasts, if some of its members do not vote
+ROUND_DURATION_SECONDS = 5
+
+# Time after which pools without any activity get evicted
+POOL_IDLE_TTL_SECONDS = 600
+
+# Minimum time between two searches for pools to evict
+POOL_EVICTION_INTERVAL_SECONDS = 10
+
+# Number of results of evicted pools kept in memory
+ARCHIVE_MAX_RECORDS = 10000
+
+# File to append results of evicted pools to (as JSON lines), or None
+ARCHIVE_PATH = None
+
+# Prefix of issued passwords, sharded deployments put the shard index here
+CREDENTIAL_PREFIX = ""
+
+# Time issued passwords stay valid, they are not stored so they cannot be revoked
+CREDENTIAL_TTL_SECONDS = 24 * 3600
+
+# Key passwords are signed with. With a write-ahead log, it is kept along
+# with the log so that passwords survive restarts, otherwise it is random.
+CREDENTIAL_SECRET = secrets.token_bytes(32)
+
+# Directory for the write-ahead log of pool changes, so that pools survive
+# restarts. If None, pools only live in memory and are lost on restart.
+WAL_DIRECTORY = os.environ.get("CONSENSUS_WAL_DIRECTORY")
+
+# Number of logged changes after which a snapshot of all pools is taken
+WAL_SNAPSHOT_EVERY_RECORDS = 100000
+
+# Time the log waits for more changes before syncing them to disk at once
+WAL_COMMIT_DELAY_SECONDS = 0
+
+# Most requests handled at the same time, others get 503 with Retry-After.
+# Note that long polls count too, for as long as they are held.
+MAX_IN_FLIGHT_REQUESTS = 512
+
+# Share of the above requests to each endpoint may take, so that the least
+# important ones get shed first. Votes are what makes pools progress, then
+# members need to see them, and new voters can always come back later.
+ADMISSION_SHARES = {
+    "/post_vote": 1.0,
+    "/vote_and_get": 1.0,
+    "/get_votes": 0.9,
+    "/join_pool": 0.75,
+}
+
+# Seconds shed requests to each endpoint are told to wait before retrying
+ADMISSION_RETRY_AFTER_SECONDS = {
+    "/post_vote": 1,
+    "/vote_and_get": 1,
+    "/get_votes": 1,
+    "/join_pool": 2,
+}
+
+# Upper bounds (in seconds) of the lock wait histogram buckets
+LOCK_WAIT_BUCKETS_SECONDS = [0.000001, 0.00001, 0.0001, 0.001, 0.01, 0.1, 1]
+
 ################################
 #       CONFIG FUNCTIONS       #
 ################################
@@ -38,104 +116,823 @@ def response_from_code(status_code, error_details = None):
     error_msg = ": ".join(filter(None, (status_code.phrase, error_details)))
     return make_response({"error": error_msg}, status_code)
 
+def vote_from_request(request, username):
+    # Returns the number voted for, or None if there is no valid vote. Votes
+    # get tallied, so they must be hashable, and null stands for no vote.
+    body = request.get_json()
+    number = body.get(username) if isinstance(body, dict) else None
+    try:
+        hash(number)
+    except TypeError:
+        return None
+    return number
+
+################################
+#      SIGNED CREDENTIALS      #
+################################
+
+# Passwords are not stored, they are signed statements that a username is
+# a member of some pool, i.e. `<prefix><pool id>.<expiry>.<HMAC>`. The pool
+# can be found straight from the password, and checking it only takes an
+# HMAC computation, which is compared in constant time.
+
+def credential_signature(username, payload):
+    message = ("%s:%s"%(username, payload)).encode("utf-8")
+    return hmac.new(CREDENTIAL_SECRET, message, hashlib.sha256).hexdigest()
+
+def issue_credentials(username, pool_id):
+    payload = "%s%d.%d"%(CREDENTIAL_PREFIX, pool_id, time.time() + CREDENTIAL_TTL_SECONDS)
+    return payload + "." + credential_signature(username, payload)
+
+def credentials_pool_id(password):
+    # Returns the pool ID claimed by a password, without checking it
+    if not password.startswith(CREDENTIAL_PREFIX):
+        return None
+    pool_id, _, _ = password[len(CREDENTIAL_PREFIX):].partition(".")
+    # `isdigit()` alone also accepts digits like "²", which `int()` does not
+    return int(pool_id) if pool_id.isascii() and pool_id.isdigit() else None
+
+def verify_credentials(username, password):
+    # Returns the pool ID of valid, unexpired passwords, or None
+    payload, _, signature = password.rpartition(".")
+    # Compared as bytes, as `compare_digest()` rejects non-ASCII strings
+    if not hmac.compare_digest(signature.encode("utf-8"), credential_signature(username, payload).encode("utf-8")):
+        return None
+    _, _, expires_at = payload.rpartition(".")
+    if int(expires_at) < time.time():
+        return None
+    return credentials_pool_id(password)
+
+def load_credential_secret(directory):
+    # Reads the key from the given directory, creating it on first use
+    path = os.path.join(directory, "credential_secret")
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        with open(path, "rb") as f:
+            return f.read()
+    secret = secrets.token_bytes(32)
+    with os.fdopen(fd, "wb") as f:
+        f.write(secret)
+        f.flush()
+        os.fsync(f.fileno())
+    return secret
+
+################################
+#           METRICS            #
+################################
+
+# Exposed in the Prometheus text format by `/metrics`. Pool gauges are
+# registered along with `ConsensusPool`, as they read its state.
+metrics_registry = MetricsRegistry()
+request_duration = metrics_registry.register(HistogramMetric(
+    "consensus_http_request_duration_seconds", "Time spent handling requests, by endpoint", ["endpoint"]))
+responses_total = metrics_registry.register(CounterMetric(
+    "consensus_http_responses", "Responses sent, by endpoint and status code (412 means contention)", ["endpoint", "code"]))
+lock_wait = metrics_registry.register(HistogramMetric(
+    "consensus_lock_wait_seconds", "Time spent waiting to acquire locks", ["lock"], LOCK_WAIT_BUCKETS_SECONDS))
+pools_evicted_total = metrics_registry.register(CounterMetric(
+    "consensus_pools_evicted", "Pools evicted since the server started"))
+rounds_closed_total = metrics_registry.register(CounterMetric(
+    "consensus_rounds_closed", "Voting rounds closed, by whether all members voted or the deadline passed", ["reason"]))
+
+################################
+#         POOL ARCHIVE         #
+################################
+
+# Evicted pools leave behind a small result record, instead of their
+# credentials and votes. The most recent ones are kept in memory and,
+# optionally, every one of them is appended to a file.
+class PoolArchive:
+    def __init__(self, max_records, path = None):
+        self.max_records = max_records
+        self.path = path
+        self.records = OrderedDict()
+        self.lock = threading.Lock()
+
+    def add(self, record):
+        with self.lock:
+            self.records[record["pool_id"]] = record
+            if len(self.records) > self.max_records:
+                self.records.popitem(last = False)
+            if self.path is not None:
+                with open(self.path, "a") as f:
+                    f.write(json.dumps(record) + "\n")
+
+    def get(self, pool_id):
+        with self.lock:
+            record = self.records.get(pool_id)
+            if record is not None:
+                self.records.move_to_end(pool_id)
+            return record
+
+################################
+#      ADMISSION  CONTROL      #
+################################
+
+# Bounds the number of requests in flight, instead of letting the server
+# take on more threads until latency collapses. Each endpoint may only use
+# its share of the bound, so lower priority requests get shed before the
+# others. Endpoints without a share are always admitted, and not counted.
+class AdmissionController:
+    def __init__(self, max_in_flight, shares):
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.limits = {endpoint: int(max_in_flight * share) for endpoint, share in shares.items()}
+
+    def try_admit(self, endpoint):
+        limit = self.limits.get(endpoint)
+        if limit is None:
+            return True
+        with self.lock:
+            if self.in_flight >= limit:
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self):
+        with self.lock:
+            self.in_flight -= 1
+
+admission = AdmissionController(MAX_IN_FLIGHT_REQUESTS, ADMISSION_SHARES)
+metrics_registry.register(GaugeMetric(
+    "consensus_requests_in_flight", "Admitted requests currently being handled", lambda : admission.in_flight))
+
+################################
+#        POOL  VERSIONS        #
+################################
+
+# Immutable state of a pool at one of its versions. Pools publish a new
+# one on every change, with their lock held, by swapping a reference, so
+# readers get a consistent state without taking any lock. Pools never
+# modify their member sequences in place but replace them, so versions
+# share them with the pool instead of copying them. The JSON body is
+# only encoded once somebody asks for it, as most versions of a busy
+# pool get replaced before that. Racing readers would encode the same.
+class PoolVersion:
+    __slots__ = ("version", "etag_salt", "round", "round_deadline", "decision", "usernames", "votes", "seqs", "changed_at", "json_body")
+
+    # Must be called with the pool lock held
+    def __init__(self, pool):
+        self.version = pool.version
+        self.etag_salt = pool.etag_salt
+        self.round = pool.round
+        # Decided pools have no more rounds
+        self.round_deadline = pool.round_deadline if not pool.consensus_reached else math.inf
+        self.decision = pool.decision
+        self.usernames = pool.usernames
+        self.votes = pool.votes
+        self.seqs = pool.seqs
+        self.changed_at = pool.changed_at
+        self.json_body = None
+
+    # Formatted when needed, as idle pools keep their latest version
+    @property
+    def etag(self):
+        return "%s-%d"%(self.etag_salt, self.version)
+
+    def round_overdue(self, now = None):
+        return (time.time() if now is None else now) >= self.round_deadline
+
+    def encoded_votes(self):
+        # Returns the `/get_votes` body of this version
+        body = self.json_body
+        if body is None:
+            body = self.json_body = json.dumps({
+                "pool_size": CONSENSUS_POOL_SIZE,
+                "min_agree": cf_get_min_agree(),
+                "round": self.round,
+                "vote_data": {username: (vote, seq) for username, vote, seq in zip(self.usernames, self.votes, self.seqs)},
+                # Clients need not count votes themselves, null until consensus
+                "decision": self.decision,
+            }, separators = (",", ":"))
+        return body
+
+    def compact_state(self, base_version):
+        # Returns the state of members changed since the base version
+        return {
+            "version": self.version,
+            "base_version": base_version,
+            "round": self.round,
+            "pool_size": CONSENSUS_POOL_SIZE,
+            "min_agree": cf_get_min_agree(),
+            "members": len(self.usernames),
+            "decision": self.decision,
+            "votes": [
+                [slot, self.votes[slot], self.seqs[slot]] for slot, version in enumerate(self.changed_at)
+                if version > base_version
+            ],
+        }
+
 ################################
 #        CONSENSUS POOL        #
 ################################
 
 class ConsensusPool:
-    # TODO: Unsure if thread safety is achieved
+    # Locking rules: `pool_list_lock` only guards the class-level pool
+    # list and indexes, while each pool's state is guarded by its own
+    # `lock`. When both are needed, `pool_list_lock` is taken first.
     pool_list = []
-    pool_list_lock = threading.Lock()
+    pool_list_lock = TimedLock(lock_wait, "pool_list")
+    # Index of members by username, to the (pool, slot) they belong to,
+    # which pools share rather than keep their own. And pools by their ID.
+    member_by_username = {}
+    pool_by_id = {}
+    # Pools which may still be joined, in creation order. The
+    # values are unused, dicts are just ordered sets in disguise
+    joinable_pools = {}
+    # Results of pools which are gone
+    archive = PoolArchive(ARCHIVE_MAX_RECORDS, ARCHIVE_PATH)
+    last_eviction = time.time()
+    next_pool_id = 0
+    # Log of changes, see `open_wal()`
+    wal = None
+    wal_lock = threading.Lock()
 
     @classmethod
-    def _find_first(cls, predicate):
-        for p in cls.pool_list:
-            if predicate(p):
-                return p
-        return None
+    def _new_pool_id(cls):
+        # Must be called with `pool_list_lock` held
+        pool_id = cls.next_pool_id
+        cls.next_pool_id += 1
+        return pool_id
+
+    @classmethod
+    def open_wal(cls, directory):
+        # Rebuilds the pools from the log before logging any new changes
+        global CREDENTIAL_SECRET
+        with cls.wal_lock:
+            if cls.wal is not None:
+                return
+            snapshot, records = recover_wal(directory)
+            CREDENTIAL_SECRET = load_credential_secret(directory)
+            cls.restore(snapshot, records)
+            cls.wal = WriteAheadLog(directory, cls.snapshot_state, WAL_SNAPSHOT_EVERY_RECORDS, WAL_COMMIT_DELAY_SECONDS)
+
+    @classmethod
+    def log_change(cls, record):
+        # Pool changes must be logged with the pool lock held, so that
+        # their records end up in the log in the order they happened
+        if cls.wal is None:
+            return
+        seq = cls.wal.append(record)
+        # The reply waits for the change to be durable, see `wait_for_wal()`
+        if has_request_context():
+            g.wal_seq = seq
+
+    @classmethod
+    def snapshot_state(cls):
+        with cls.pool_list_lock:
+            pools = list(cls.pool_list)
+            next_pool_id = cls.next_pool_id
+        return {"next_pool_id": next_pool_id, "pools": [p.to_snapshot() for p in pools]}
+
+    @classmethod
+    def restore(cls, snapshot, records):
+        pools = {}
+        members = {}
+        next_pool_id = 0
+        if snapshot is not None:
+            for state in snapshot["pools"]:
+                pool = pools[state["pool_id"]] = ConsensusPool.from_snapshot(state)
+                members.update((username, (pool, slot)) for slot, username in enumerate(pool.usernames))
+            next_pool_id = snapshot["next_pool_id"]
+        # Records already included in the snapshot get skipped, as they
+        # do not bump the version of their pool by exactly one
+        for record in records:
+            pool = pools.get(record["pool_id"])
+            match record:
+                case {"op": "join", "pool_id": pool_id, "etag_salt": etag_salt, "created_at": created_at}:
+                    if pool is None:
+                        pool = pools[pool_id] = ConsensusPool(pool_id, etag_salt, created_at)
+                    with pool.lock:
+                        if record["version"] == pool.version + 1:
+                            members[record["username"]] = (pool, len(pool.usernames))
+                            pool.add_member(record["username"], record["time"])
+                case {"op": "vote"} if pool is not None:
+                    with pool.lock:
+                        if record["version"] == pool.version + 1:
+                            _, slot = members[record["username"]]
+                            pool.apply_vote(slot, record["vote"], record["time"])
+                case {"op": "round"} if pool is not None:
+                    with pool.lock:
+                        if record["version"] == pool.version + 1:
+                            pool.close_round(record["time"])
+                case {"op": "evict", "pool_id": pool_id}:
+                    if pool_id in pools:
+                        for username in pools.pop(pool_id).usernames:
+                            del members[username]
+            next_pool_id = max(next_pool_id, record["pool_id"] + 1)
+        with cls.pool_list_lock:
+            cls.pool_list = sorted(pools.values(), key = lambda p : p.pool_id)
+            cls.member_by_username = members
+            cls.pool_by_id = {p.pool_id: p for p in cls.pool_list}
+            cls.joinable_pools = {p: None for p in cls.pool_list if p.is_joinable()}
+            cls.next_pool_id = next_pool_id
+
+    @classmethod
+    def reset(cls):
+        # Forget about every pool, e.g. between benchmark runs. This is
+        # not logged, so it must not be used along with a write-ahead log.
+        with cls.pool_list_lock:
+            cls.pool_list = []
+            cls.member_by_username = {}
+            cls.pool_by_id = {}
+            cls.joinable_pools = {}
+            cls.next_pool_id = 0
+            cls.last_eviction = time.time()
+        cls.archive = PoolArchive(ARCHIVE_MAX_RECORDS, ARCHIVE_PATH)
+
+    @classmethod
+    def evict_stale_pools(cls, now = None):
+        now = time.time() if now is None else now
+        with cls.pool_list_lock:
+            cls.last_eviction = now
+            kept, evicted = [], []
+            for p in cls.pool_list:
+                (evicted if p.is_stale(now) else kept).append(p)
+            cls.pool_list = kept
+            for pool in evicted:
+                cls.log_change({"op": "evict", "pool_id": pool.pool_id})
+                cls.joinable_pools.pop(pool, None)
+                del cls.pool_by_id[pool.pool_id]
+                for username in pool.usernames:
+                    cls.member_by_username.pop(username, None)
+        for pool in evicted:
+            cls.archive.add(pool.result_record(now))
+        pools_evicted_total.inc(amount = len(evicted))
+        return evicted
+
+    @classmethod
+    def maybe_evict_stale_pools(cls):
+        # Amortize the eviction scan over incoming requests
+        if time.time() - cls.last_eviction >= POOL_EVICTION_INTERVAL_SECONDS:
+            cls.evict_stale_pools()
+
+    @classmethod
+    def _discard_joinable(cls, pool):
+        with cls.pool_list_lock:
+            cls.joinable_pools.pop(pool, None)
+
+    @classmethod
+    def member_for_username(cls, username):
+        # Single dict lookups are atomic, and usernames only get indexed
+        # once their pool is populated, so no lock is needed for reading.
+        # Returns the (pool, slot) of the member, or None.
+        return cls.member_by_username.get(username)
 
     @classmethod
     def pool_for_username(cls, username):
+        member = cls.member_for_username(username)
+        return member[0] if member is not None else None
+
+    @classmethod
+    def archived_result(cls, username, password):
+        # Members of evicted pools may still find out how they ended, with
+        # a valid password for the pool, as they are not members of it anymore
+        pool_id = verify_credentials(username, password)
+        record = cls.archive.get(pool_id) if pool_id is not None else None
+        if record is None:
+            return response_from_code(HTTPStatus.UNAUTHORIZED)
+        return make_response(({"error": HTTPStatus.GONE.phrase, **record}, HTTPStatus.GONE))
+
+    @classmethod
+    def pool_for_password(cls, password):
+        # Lock-free too, the password still has to be checked by the pool
+        pool_id = credentials_pool_id(password)
+        return cls.pool_by_id.get(pool_id) if pool_id is not None else None
+
+    @classmethod
+    def _join_any_pool(cls, username):
+        # Returns None if the username joined while waiting for the lock
         with cls.pool_list_lock:
-            return cls._find_first(lambda p : username in p.login_cookies.keys())
+            if username in cls.member_by_username:
+                return None
+            while True:
+                # Find an existing pool that can be joined
+                pool = next(iter(cls.joinable_pools), None)
+                if pool is None:
+                    # Or create a new pool if none could be found
+                    pool = ConsensusPool(cls._new_pool_id())
+                    cls.pool_list.append(pool)
+                    cls.pool_by_id[pool.pool_id] = pool
+                    cls.joinable_pools[pool] = None
+                with pool.lock:
+                    # Pools only leave the registry after they stop being
+                    # joinable, so stale entries may be found here
+                    if not pool.is_joinable():
+                        del cls.joinable_pools[pool]
+                        continue
+                    slot = len(pool.usernames)
+                    password = pool.add_member(username)
+                    still_joinable = pool.is_joinable()
+                # Only make the username known once the pool is populated
+                cls.member_by_username[username] = (pool, slot)
+                if not still_joinable:
+                    del cls.joinable_pools[pool]
+                return password
 
     @classmethod
     def route_incoming_voter(cls, username, password):
         # Route clients with a known username back to their pool
         # Note that the client implementation does not reconnect
-        pool = cls.pool_for_username(username)
-        if pool is None:
+        member = cls.member_for_username(username)
+        if member is None:
             # We do not know this username, treat it as new client
-            with cls.pool_list_lock:
-                # Find an existing pool that can be joined
-                pool = cls._find_first(lambda p : p.is_joinable())
-                if pool is None:
-                    # Or create a new pool if none could be found
-                    pool = ConsensusPool()
-                    cls.pool_list.append(pool)
-            # Populate the pool with the client information
-            pool.login_cookies[username] = secrets.token_hex(256)
-            pool.vote_sequence[username] = (None, 0) # voted number, sequence number
-            return make_response(({"password": pool.login_cookies[username]}, HTTPStatus.CREATED))
-        else:
-            # Known username that requested to rejoin, try to authenticate
-            # TODO: If this fails, retry with other pools?
-            def do_check_creds():
-                return make_response(({}, HTTPStatus.OK))
-            return pool.validate_creds_and_run(username, password, do_check_creds)
+            cls.maybe_evict_stale_pools()
+            new_password = cls._join_any_pool(username)
+            member = cls.member_for_username(username)
+            if new_password is not None:
+                _, slot = member
+                return make_response(({"password": new_password, "slot": slot}, HTTPStatus.CREATED))
+        # Known username that requested to rejoin, try to authenticate
+        # TODO: If this fails, retry with other pools?
+        pool, slot = member
+        def do_check_creds():
+            return make_response(({"slot": slot}, HTTPStatus.OK))
+        return pool.validate_creds_and_run(username, password, do_check_creds)
 
-    def __init__(self):
-        # TODO: There can be threading issues in this class
-        #       specifically regarding the Etag calculation
-        self.login_cookies = {}
-        self.vote_sequence = {}
+    # Servers hold lots of small pools, so they are kept as lean as possible
+    __slots__ = (
+        "lock", "changed", "watchers", "latest", "usernames", "votes", "seqs", "changed_at",
+        "version", "etag_salt", "pool_id", "created_at", "last_active", "tally", "leader", "leader_count",
+        "consensus_reached", "decided_at", "decision", "round", "round_deadline", "round_voters", "live_members",
+    )
 
-    def is_joinable(self):
-        if len(self.login_cookies) < CONSENSUS_POOL_SIZE:
-            # The pool itself has room, check if consensus has been reached
-            votes = [v for v, _ in self.vote_sequence.values() if v is not None]
-            if len(votes) == 0:
-                # Empty pool? Should never happen
-                return True
-            # Do not allow joining a pool where consensus has already been reached
-            _, count = Counter(votes).most_common(1)[0]
-            return count < cf_get_min_agree()
-        else:
+    def __init__(self, pool_id, etag_salt = None, created_at = None):
+        self.lock = TimedLock(lock_wait, "pool")
+        # Notified whenever the pool changes, used for long polling. The
+        # watchers are callbacks for waiters which cannot block a thread.
+        # Both are only created once somebody waits, see `wait_for_change()`.
+        self.changed = None
+        self.watchers = None
+        # Members are numbered in the order they joined, their slot indexes
+        # these. Their votes are any JSON value, hence not a typed array.
+        # The pool version of their last change is kept for compact pool
+        # states. Passwords are not stored, see above. These are shared
+        # with `latest`, so they get replaced rather than modified.
+        self.usernames = ()
+        self.votes = ()
+        self.seqs = array("Q")
+        self.changed_at = array("Q")
+        # The Etag is a version number bumped on every change. It is
+        # salted so that clients cannot guess Etags they never saw.
+        self.version = 0
+        self.etag_salt = secrets.token_hex(8) if etag_salt is None else etag_salt
+        # Lifecycle information, timestamps are wall-clock times
+        self.pool_id = pool_id
+        self.created_at = time.time() if created_at is None else created_at
+        self.last_active = self.created_at
+        # Number of members currently voting for each number, kept up to
+        # date on every vote along with the leading number and its count
+        self.tally = Counter()
+        self.leader = None
+        self.leader_count = 0
+        # Consensus is final, even if votes keep changing afterwards
+        self.consensus_reached = False
+        self.decided_at = None
+        self.decision = None
+        # Voting rounds, see `close_round()`. Live members are the ones
+        # which voted in the previous round, 0 meaning every member. Both
+        # are bit masks of member slots.
+        self.round = 0
+        self.round_deadline = self.created_at + ROUND_DURATION_SECONDS
+        self.round_voters = 0
+        self.live_members = 0
+        # What readers get to see, see `PoolVersion`
+        self.latest = PoolVersion(self)
+
+    def to_snapshot(self):
+        with self.lock:
+            return {
+                "pool_id": self.pool_id,
+                "etag_salt": self.etag_salt,
+                "version": self.version,
+                "created_at": self.created_at,
+                "last_active": self.last_active,
+                "decided_at": self.decided_at,
+                "decision": self.decision,
+                "round": self.round,
+                "round_deadline": self.round_deadline,
+                "round_voters": self.usernames_in(self.round_voters),
+                "live_members": self.usernames_in(self.live_members) if self.live_members else None,
+                "members": [list(member) for member in zip(self.usernames, self.votes, self.seqs)],
+            }
+
+    @classmethod
+    def from_snapshot(cls, state):
+        pool = cls(state["pool_id"], state["etag_salt"], state["created_at"])
+        pool.version = state["version"]
+        pool.last_active = state["last_active"]
+        pool.decided_at = state["decided_at"]
+        pool.decision = state["decision"]
+        pool.consensus_reached = pool.decided_at is not None
+        pool.round = state["round"]
+        pool.round_deadline = state["round_deadline"]
+        members = state["members"]
+        pool.usernames = tuple(username for username, _, _ in members)
+        pool.votes = tuple(vote for _, vote, _ in members)
+        pool.seqs = array("Q", (seq for _, _, seq in members))
+        pool.changed_at = array("Q", [pool.version] * len(members))
+        pool.tally.update(vote for vote in pool.votes if vote is not None)
+        pool.round_voters = pool.slot_mask(state["round_voters"])
+        pool.live_members = pool.slot_mask(state["live_members"] or ())
+        if pool.tally:
+            pool.leader, pool.leader_count = pool.tally.most_common(1)[0]
+        pool.latest = PoolVersion(pool)
+        return pool
+
+    # Must be called with the pool lock held
+    def add_member(self, username, now = None):
+        # Populate the pool with the client information
+        self.usernames += (username,)
+        self.votes += (None,)
+        self.seqs = self.seqs + array("Q", [0])
+        self.version += 1
+        self.changed_at = self.changed_at + array("Q", [self.version])
+        self.last_active = time.time() if now is None else now
+        ConsensusPool.log_change({
+            "op": "join",
+            "pool_id": self.pool_id,
+            "etag_salt": self.etag_salt,
+            "created_at": self.created_at,
+            "version": self.version,
+            "username": username,
+            "time": self.last_active,
+        })
+        self.notify_changed()
+        return issue_credentials(username, self.pool_id)
+
+    # Must be called with the pool lock held
+    def apply_vote(self, slot, number, now = None):
+        old_number = self.votes[slot]
+        self.votes = self.votes[:slot] + (number,) + self.votes[slot + 1:]
+        self.seqs = array("Q", self.seqs)
+        self.seqs[slot] += 1
+        self.version += 1
+        self.changed_at = array("Q", self.changed_at)
+        self.changed_at[slot] = self.version
+        self.last_active = time.time() if now is None else now
+        self.update_tally(old_number, number)
+        if not self.consensus_reached and self.leader_count >= cf_get_min_agree():
+            self.consensus_reached = True
+            self.decision = self.leader
+            self.decided_at = self.last_active
+        ConsensusPool.log_change({
+            "op": "vote",
+            "pool_id": self.pool_id,
+            "version": self.version,
+            "username": self.usernames[slot],
+            "vote": number,
+            "time": self.last_active,
+        })
+        self.notify_changed()
+        self.round_voters |= 1 << slot
+        if not self.consensus_reached and self.round_complete():
+            rounds_closed_total.inc("all_voted")
+            self.close_round(self.last_active)
+
+    # Must be called with the pool lock held
+    def round_complete(self):
+        # A lone voter waiting for others to join must not get new rounds
+        # right away, as with the soft-lockstep clients used to enforce
+        if self.round_voters.bit_count() < cf_get_min_agree():
             return False
+        live_members = self.live_members or (1 << len(self.usernames)) - 1
+        return self.round_voters & live_members == live_members
+
+    # Must be called with the pool lock held
+    def close_round(self, now):
+        # Rounds end once every live member voted, or when their deadline
+        # passes, so that members waiting for others always get to vote
+        # again in bounded time. The version is bumped, waking up waiters.
+        self.round += 1
+        self.round_deadline = now + ROUND_DURATION_SECONDS
+        self.live_members = self.round_voters
+        self.round_voters = 0
+        self.version += 1
+        ConsensusPool.log_change({
+            "op": "round",
+            "pool_id": self.pool_id,
+            "version": self.version,
+            "round": self.round,
+            "time": now,
+        })
+        self.notify_changed()
+
+    # Must be called with the pool lock held
+    def close_round_if_due(self, now = None):
+        now = time.time() if now is None else now
+        if not self.consensus_reached and now >= self.round_deadline:
+            rounds_closed_total.inc("deadline")
+            self.close_round(now)
+
+    # Must be called with the pool lock held
+    def seconds_until_round_deadline(self):
+        if self.consensus_reached:
+            return math.inf
+        return max(self.round_deadline - time.time(), 0)
+
+    # Must be called with the pool lock held
+    def update_tally(self, old_number, number):
+        if old_number is not None:
+            self.tally[old_number] -= 1
+            if self.tally[old_number] == 0:
+                del self.tally[old_number]
+        self.tally[number] += 1
+        if self.tally[number] > self.leader_count or number == self.leader:
+            self.leader, self.leader_count = number, self.tally[number]
+        elif old_number == self.leader and old_number != number:
+            # The leader lost a vote, there are at most as many distinct
+            # numbers as members to look through for the new one
+            self.leader, self.leader_count = self.tally.most_common(1)[0]
+
+    # Must be called with the pool lock held
+    def slot_mask(self, usernames):
+        return sum(1 << self.usernames.index(username) for username in usernames)
+
+    # Must be called with the pool lock held
+    def usernames_in(self, mask):
+        return [username for slot, username in enumerate(self.usernames) if mask >> slot & 1]
+
+    # Must be called with the pool lock held
+    def notify_changed(self):
+        # Publish the new version before waking up anyone looking for it
+        self.latest = PoolVersion(self)
+        if self.changed is not None:
+            self.changed.notify_all()
+        if self.watchers:
+            for watcher in self.watchers:
+                watcher()
+
+    # Must be called with the pool lock held
+    def add_watcher(self, watcher):
+        if self.watchers is None:
+            self.watchers = set()
+        self.watchers.add(watcher)
+
+    # Must be called with the pool lock held
+    def remove_watcher(self, watcher):
+        self.watchers.discard(watcher)
+
+    # Must be called with the pool lock held
+    def is_joinable(self):
+        # Do not allow joining a pool where consensus has already been reached
+        return len(self.usernames) < CONSENSUS_POOL_SIZE and not self.consensus_reached
+
+    def is_stale(self, now):
+        # Reads without the pool lock, a slightly outdated view is fine here
+        if self.decided_at is not None:
+            return now - self.decided_at >= POOL_DECIDED_TTL_SECONDS
+        return now - self.last_active >= POOL_IDLE_TTL_SECONDS
+
+    def result_record(self, evicted_at):
+        with self.lock:
+            return {
+                "pool_id": self.pool_id,
+                "decision": self.decision,
+                "size": len(self.usernames),
+                # Rounds are numbered from 0
+                "rounds": self.round + 1,
+                "created_at": self.created_at,
+                "decided_at": self.decided_at,
+                "evicted_at": evicted_at,
+            }
+
+    def slot_of(self, username):
+        # Members never leave their pool, no lock needed
+        member = ConsensusPool.member_for_username(username)
+        return member[1] if member is not None and member[0] is self else None
+
+    def check_creds(self, username, password):
+        return verify_credentials(username, password) == self.pool_id and self.slot_of(username) is not None
 
     def validate_creds_and_run(self, username, password, func):
-        if self.login_cookies[username] == password:
+        if self.check_creds(username, password):
+            self.last_active = time.time()
             return func() # N.B. this is meant to be a nested function
         else:
             return response_from_code(HTTPStatus.FORBIDDEN, "Incorrect password")
 
     def calculate_etag(self):
-        return sha512(json.dumps(self.vote_sequence).encode("utf-8")).hexdigest()
+        return "%s-%d"%(self.etag_salt, self.version)
+
+    def parse_etag(self, etag):
+        # Returns the version of one of our Etags, or None for foreign ones
+        salt, _, version = etag.partition("-")
+        if salt == self.etag_salt and version.isascii() and version.isdigit():
+            return int(version)
+        return None
+
+    def parse_etag_versions(self, etags):
+        # Parse outside the lock, as the salt never changes
+        if etags.star_tag:
+            return None
+        return {self.parse_etag(etag) for etag in etags}
+
+    def compare_and_set_vote(self, slot, number, expected_versions):
+        # The precondition check and the update are a single atomic step.
+        # Expecting no particular version means `If-Match: *` was used.
+        with self.lock:
+            # Votes are meant for the round the client saw
+            self.close_round_if_due()
+            if expected_versions is not None and self.version not in expected_versions:
+                return False
+            self.apply_vote(slot, number)
+            joinable = self.is_joinable()
+        # Reaching consensus makes the pool no longer joinable. Pools never
+        # get back into the registry, so only take the lock if it is there.
+        if not joinable and self in ConsensusPool.joinable_pools:
+            ConsensusPool._discard_joinable(self)
+        return True
+
+    # Must be called with the pool lock held
+    def wait_for_change(self, known_versions, timeout):
+        # Returns whether the pool is at a version not known by the client.
+        # Nothing else closes overdue rounds, so wake up to do it if needed.
+        end_time = time.monotonic() + timeout
+        while True:
+            self.close_round_if_due()
+            if self.version not in known_versions:
+                return True
+            remaining = end_time - time.monotonic()
+            if remaining <= 0:
+                return False
+            if self.changed is None:
+                self.changed = threading.Condition(self.lock)
+            self.changed.wait(min(remaining, self.seconds_until_round_deadline()))
 
     def get_votes(self, username, password, request):
         def do_get_votes():
-            data = jsonify({
-                "pool_size": CONSENSUS_POOL_SIZE,
-                "min_agree": cf_get_min_agree(),
-                "vote_data": self.vote_sequence,
-            })
-            resp = make_response((data, HTTPStatus.OK))
-            resp.set_etag(self.calculate_etag())
-            return resp
+            # Long polling: with `wait`, hold the request until the pool
+            # no longer matches If-None-Match, or reply 304 on timeout
+            wait = request.args.get("wait", type = float)
+            known_versions = self.parse_etag_versions(request.if_none_match) or set()
+            timeout = min(max(wait, 0), LONG_POLL_MAX_WAIT_SECONDS) if wait is not None else 0
+            latest = self.latest
+            # The lock is only needed to wait, or to close an overdue round
+            if (timeout > 0 and latest.version in known_versions) or latest.round_overdue():
+                with self.lock:
+                    self.wait_for_change(known_versions, timeout)
+                latest = self.latest
+            # The client already has this version, do not bother encoding it
+            if latest.version in known_versions:
+                resp = make_response(("", HTTPStatus.NOT_MODIFIED))
+                resp.set_etag(latest.etag)
+                return resp
+            return self.votes_response(HTTPStatus.OK, request, known_versions, latest)
         return self.validate_creds_and_run(username, password, do_get_votes)
 
+    def votes_response(self, status_code, request, known_versions, latest = None):
+        # Compact representations only hold changes since the newest version
+        # the client knows about, JSON is the default and is always complete
+        latest = self.latest if latest is None else latest
+        mimetype = request.accept_mimetypes.best_match(POOL_STATE_MIMETYPES, default = JSON_MIMETYPE)
+        if mimetype != JSON_MIMETYPE:
+            state = latest.compact_state(max(filter(None, known_versions or ()), default = 0))
+            try:
+                body = encode_packed(state) if mimetype == PACKED_MIMETYPE else encode_compact_json(state)
+            except struct.error:
+                # Votes which are not 32-bit integers cannot be packed
+                mimetype = JSON_MIMETYPE
+        if mimetype == JSON_MIMETYPE:
+            body = latest.encoded_votes()
+        resp = Response(body, status_code, mimetype = mimetype)
+        resp.set_etag(latest.etag)
+        resp.vary.add("Accept")
+        return resp
+
     def post_vote(self, username, password, request):
         def do_post_vote():
-            print(request.if_match)
-            if self.calculate_etag() in request.if_match:
-                number = request.get_json()[username]
-                (_, seq_number) = self.vote_sequence[username]
-                self.vote_sequence[username] = (number, seq_number + 1)
+            number = vote_from_request(request, username)
+            if number is None:
+                return response_from_code(HTTPStatus.BAD_REQUEST, "Invalid vote")
+            if self.compare_and_set_vote(self.slot_of(username), number, self.parse_etag_versions(request.if_match)):
                 return make_response(({}, HTTPStatus.OK))
             else:
                 return response_from_code(HTTPStatus.PRECONDITION_FAILED)
         return self.validate_creds_and_run(username, password, do_post_vote)
 
+    def vote_and_get_votes(self, username, password, request):
+        # Like `post_vote()`, but always replies with the resulting pool
+        # state, so that clients need no extra `/get_votes` afterwards
+        def do_vote_and_get_votes():
+            number = vote_from_request(request, username)
+            if number is None:
+                return response_from_code(HTTPStatus.BAD_REQUEST, "Invalid vote")
+            expected_versions = self.parse_etag_versions(request.if_match)
+            if self.compare_and_set_vote(self.slot_of(username), number, expected_versions):
+                return self.votes_response(HTTPStatus.OK, request, expected_versions)
+            else:
+                return self.votes_response(HTTPStatus.PRECONDITION_FAILED, request, expected_versions)
+        return self.validate_creds_and_run(username, password, do_vote_and_get_votes)
+
+metrics_registry.register(GaugeMetric(
+    "consensus_pools_active", "Pools currently kept in memory", lambda : len(ConsensusPool.pool_list)))
+metrics_registry.register(GaugeMetric(
+    "consensus_pools_joinable", "Pools which new voters may still join", lambda : len(ConsensusPool.joinable_pools)))
+metrics_registry.register(GaugeMetric(
+    "consensus_pools_archived", "Results of evicted pools kept in the archive", lambda : len(ConsensusPool.archive.records)))
+
 ################################
 #    CURSED DECORATOR STUFF    #
 ################################
@@ -162,7 +959,6 @@ def require_json(func):
     # Decorator to ensure request is JSON
     @functools.wraps(func)
     def wrapper(username, password, request):
-        print(request.headers["Content-Type"])
         if request.is_json:
             return func(username, password, request)
         else:
@@ -186,12 +982,12 @@ def require_precondition(precondition):
     return decorator
 
 def require_pool(func):
-    # Decorator to retrieve a pool by username
+    # Decorator to retrieve a pool by the ID in the password
     @functools.wraps(func)
     def wrapper(username, password, request):
-        pool = ConsensusPool.pool_for_username(username)
+        pool = ConsensusPool.pool_for_password(password)
         if pool is None:
-            return response_from_code(HTTPStatus.UNAUTHORIZED)
+            return ConsensusPool.archived_result(username, password)
         else:
             return func(pool, username, password, request)
     # Return decorated function
@@ -203,6 +999,54 @@ def require_pool(func):
 
 app = Flask(__name__)
 
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    # Registered first so that it runs last, i.e. after waiting for the log
+    endpoint = g_request.url_rule.rule if g_request.url_rule is not None else "unmatched"
+    request_duration.observe(time.perf_counter() - g.request_start, endpoint)
+    responses_total.inc(endpoint, str(response.status_code))
+    return response
+
+@app.before_request
+def admit_request():
+    # Runs before anything else touches the pools. The asyncio server calls
+    # the app for one request at a time, so this only ever sheds requests
+    # with threaded servers.
+    endpoint = g_request.url_rule.rule if g_request.url_rule is not None else None
+    if not admission.try_admit(endpoint):
+        resp = response_from_code(HTTPStatus.SERVICE_UNAVAILABLE, "Server overloaded")
+        resp.headers["Retry-After"] = str(ADMISSION_RETRY_AFTER_SECONDS.get(endpoint, 1))
+        return resp
+    g.admitted = endpoint in admission.limits
+
+@app.teardown_request
+def release_request(exc):
+    if g.get("admitted"):
+        admission.release()
+
+@app.before_request
+def open_wal():
+    # Opened on the first request rather than on import, so that merely
+    # importing this module (e.g. to shard it) does not touch the log
+    if WAL_DIRECTORY is not None and ConsensusPool.wal is None:
+        ConsensusPool.open_wal(WAL_DIRECTORY)
+
+@app.after_request
+def wait_for_wal(response):
+    # Group commit: do not reply before our changes are durable. Servers
+    # which cannot block in here ask to do the waiting on their own.
+    seq = g.get("wal_seq")
+    if seq is not None:
+        if "consensus.defer_durability" in g_request.environ:
+            g_request.environ["consensus.wal_seq"] = seq
+        else:
+            ConsensusPool.wal.wait_durable(seq)
+    return response
+
 @app.post("/join_pool")
 def do_join_pool():
     @require_auth
@@ -228,10 +1072,24 @@ def do_post_vote():
         return pool.post_vote(username, password, request)
     return post_vote(g_request._get_current_object())
 
+@app.post("/vote_and_get")
+def do_vote_and_get():
+    @require_auth
+    @require_json
+    @require_precondition("If-Match")
+    @require_pool
+    def vote_and_get(pool, username, password, request):
+        return pool.vote_and_get_votes(username, password, request)
+    return vote_and_get(g_request._get_current_object())
+
 @app.get("/get_pool_size")
 def do_get_pool_size():
     return make_response(({"pool_size": CONSENSUS_POOL_SIZE}, HTTPStatus.OK))
 
+@app.get("/metrics")
+def do_get_metrics():
+    return Response(metrics_registry.render(), HTTPStatus.OK, mimetype = "text/plain; version=0.0.4")
+
 @app.get("/brew_coffee")
 def do_brew_coffee():
     return response_from_code(HTTPStatus.IM_A_TEAPOT)
@@ -0,0 +1,175 @@
+import asyncio
+import binascii
+import multiprocessing
+import os
+import signal
+import sys
+
+from base64 import b64decode
+
+import server
+from async_server import BadRequest, LISTEN_BACKLOG, MAX_REQUEST_HEAD_BYTES, error_response, read_request, serve
+
+################################
+#       CONFIG CONSTANTS       #
+################################
+
+# Host and port the front acceptor listens on, empty host means all interfaces
+SERVER_HOST = ""
+SERVER_PORT = 5000
+
+# Shard servers only listen on localhost, on this port plus their index
+SHARD_PORT_BASE = 5100
+
+# Default number of shards, i.e. worker processes
+DEFAULT_NUM_SHARDS = os.cpu_count() or 1
+
+################################
+#        SHARD  ROUTING        #
+################################
+
+# Every worker process runs its own `ConsensusPool` state, so pools are
+# disjoint by construction. Passwords issued by a shard start with its
+# index (e.g. `3.<token>`), and voters send them on every request, so
+# the front acceptor can route them back without keeping any state.
+#
+# Routing new voters by a hash of their (random) usernames would spread
+# the members of a pool across shards, and pools would never fill up.
+# Instead, new voters are sent to shards in groups of a pool's size.
+
+def parse_basic_auth(headers):
+    for name, value in headers:
+        if name.lower() == "authorization":
+            scheme, _, credentials = value.partition(" ")
+            if scheme.lower() != "basic":
+                return None
+            try:
+                username, _, password = b64decode(credentials).decode("utf-8").partition(":")
+            except (binascii.Error, UnicodeDecodeError):
+                return None
+            return username, password
+    return None
+
+def shard_for_password(password, num_shards):
+    prefix, dot, _ = password.partition(".")
+    if dot and prefix.isascii() and prefix.isdigit() and int(prefix) < num_shards:
+        return int(prefix)
+    return None
+
+def run_shard(index, wal_directory):
+    server.CREDENTIAL_PREFIX = "%d."%index
+    # Every shard logs its own pools, so it needs a log of its own
+    if wal_directory is not None:
+        server.WAL_DIRECTORY = os.path.join(wal_directory, "shard-%d"%index)
+    try:
+        asyncio.run(serve("127.0.0.1", SHARD_PORT_BASE + index))
+    except KeyboardInterrupt:
+        pass
+
+################################
+#        FRONT ACCEPTOR        #
+################################
+
+def encode_request(method, target, version, headers, body):
+    # Connections to shards are always kept alive
+    lines = [f"{method} {target} {version}"]
+    lines.extend(f"{name}: {value}" for name, value in headers if name.lower() != "connection")
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body
+
+async def forward_response(upstream_reader, writer, keep_alive):
+    head = await upstream_reader.readuntil(b"\r\n\r\n")
+    status_line, *header_lines = head.decode("latin-1").split("\r\n")[:-2]
+    lines = [status_line]
+    content_length = 0
+    for line in header_lines:
+        name, _, value = line.partition(":")
+        if name.lower() == "content-length":
+            content_length = int(value)
+        if name.lower() != "connection":
+            lines.append(line)
+    lines.append("Connection: " + ("keep-alive" if keep_alive else "close"))
+    body = await upstream_reader.readexactly(content_length)
+    writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body)
+    await writer.drain()
+
+class FrontAcceptor:
+    def __init__(self, num_shards):
+        self.num_shards = num_shards
+        self.num_new_voters = 0
+
+    def route(self, headers):
+        auth = parse_basic_auth(headers)
+        # Requests without credentials do not touch any pool
+        if auth is None:
+            return 0
+        shard = shard_for_password(auth[1], self.num_shards)
+        if shard is None:
+            # Presumably a new voter, shards get whole pools of them
+            shard = (self.num_new_voters // server.CONSENSUS_POOL_SIZE) % self.num_shards
+            self.num_new_voters += 1
+        return shard
+
+    async def handle_connection(self, reader, writer):
+        # Connections to shards are opened lazily, one per shard in use
+        upstreams = {}
+        try:
+            while True:
+                try:
+                    request = await read_request(reader)
+                except BadRequest as e:
+                    writer.write(error_response(e.status_code))
+                    await writer.drain()
+                    return
+                if request is None:
+                    return
+                method, target, version, headers, body, keep_alive = request
+                shard = self.route(headers)
+                if shard not in upstreams:
+                    upstreams[shard] = await asyncio.open_connection("127.0.0.1", SHARD_PORT_BASE + shard)
+                upstream_reader, upstream_writer = upstreams[shard]
+                upstream_writer.write(encode_request(method, target, version, headers, body))
+                await forward_response(upstream_reader, writer, keep_alive)
+                if not keep_alive:
+                    return
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            for _, upstream_writer in upstreams.values():
+                upstream_writer.close()
+            writer.close()
+
+    async def wait_for_shards(self):
+        for shard in range(self.num_shards):
+            while True:
+                try:
+                    _, writer = await asyncio.open_connection("127.0.0.1", SHARD_PORT_BASE + shard)
+                    writer.close()
+                    break
+                except ConnectionRefusedError:
+                    await asyncio.sleep(0.1)
+
+    async def serve(self, host, port):
+        await self.wait_for_shards()
+        listener = await asyncio.start_server(self.handle_connection, host or None, port, limit = MAX_REQUEST_HEAD_BYTES, backlog = LISTEN_BACKLOG)
+        print(f"Routing requests on '{host}:{port}' to {self.num_shards} shards...")
+        async with listener:
+            await listener.serve_forever()
+
+if __name__ == "__main__":
+    num_shards = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_NUM_SHARDS
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else SERVER_PORT
+    if num_shards < 1:
+        print(f"usage: {sys.argv[0]} [<number of shards> [<port>]]")
+        sys.exit(1)
+    # Make sure the shards get stopped when we get terminated too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    shards = [multiprocessing.Process(target = run_shard, args = (i, server.WAL_DIRECTORY), daemon = True) for i in range(num_shards)]
+    for shard in shards:
+        shard.start()
+    try:
+        asyncio.run(FrontAcceptor(num_shards).serve(SERVER_HOST, port))
+    except KeyboardInterrupt:
+        print("Byeeeee!")
+    finally:
+        for shard in shards:
+            shard.terminate()
@@ -0,0 +1,274 @@
+import argparse
+import json
+import math
+import sys
+import time
+
+import numpy as np
+
+import client
+import server
+
+################################
+#       CONFIG CONSTANTS       #
+################################
+
+# Default number of pools to simulate
+DEFAULT_NUM_POOLS = 1000000
+
+# Pools are simulated this many at a time, which bounds memory usage
+BATCH_NUM_POOLS = 100000
+
+# Numbers voted for are drawn uniformly below this, as `cf_get_vote_value()` does
+DEFAULT_VOTE_RANGE = 25
+
+# Scale and shape of the Weibull backoff after a rejected vote, as `cf_client_wait_seconds()` does
+DEFAULT_BACKOFF_SCALE = 1.0
+DEFAULT_BACKOFF_SHAPE = 5.0
+
+# Default one-way network latency between clients and the server
+DEFAULT_LATENCY_SECONDS = 0.001
+
+# Members send their first request at a uniformly random time below this
+DEFAULT_JOIN_SPREAD_SECONDS = 1.0
+
+# Pools not settled after this long are given up on
+MAX_SIMULATED_SECONDS = 3600
+
+# Percentiles reported for each distribution
+REPORT_PERCENTILES = [50, 90, 99, 99.9]
+
+################################
+#        POOL  SIMULATOR       #
+################################
+
+# Simulates whole pools of `Client`s against `ConsensusPool`, without any
+# server or network, to find out how quickly parameters lead to consensus.
+# Pools start full, and every member follows `Client.loop()`: long poll,
+# vote once per round (retrying rejected votes after a backoff) and stop
+# once it learns the decision. Requests are handled the moment they reach
+# the server, and replies take the same latency to get back.
+#
+# Each step handles the earliest event of every pool still going: a request
+# reaching the server, a long poll timing out, or the deadline of a round
+# passing while somebody waits. Pools are rows of arrays, members columns,
+# so that a step is a handful of NumPy operations on all pools at once.
+
+class SimulatedPools:
+    def __init__(self, num_pools, args, rng):
+        self.args = args
+        self.rng = rng
+        shape = (num_pools, args.pool_size)
+        self.all_members = (1 << args.pool_size) - 1
+        self.poll_seconds = min(client.LONG_POLL_WAIT_SECONDS, server.LONG_POLL_MAX_WAIT_SECONDS)
+        # Pool state, as kept by `ConsensusPool`
+        self.version = np.zeros(num_pools, np.int64)
+        self.round = np.zeros(num_pools, np.int64)
+        self.round_deadline = np.full(num_pools, args.round_duration)
+        self.round_voters = np.zeros(num_pools, np.int64)
+        self.live_members = np.zeros(num_pools, np.int64)
+        self.votes = np.full(shape, -1, np.int64)
+        self.decided_at = np.full(num_pools, np.nan)
+        self.decided_round = np.full(num_pools, -1, np.int64)
+        # Member state, as kept by `Client`. Members send their next request
+        # (a vote or a long poll) at `next_request`, or are held by the
+        # server until `poll_timeout`, or are done (both infinite).
+        self.next_request = rng.uniform(0, args.join_spread, shape)
+        self.posting = np.zeros(shape, bool)
+        self.poll_timeout = np.full(shape, np.inf)
+        self.seen_version = np.full(shape, -1, np.int64)
+        self.seen_round = np.zeros(shape, np.int64)
+        self.voted_round = np.full(shape, -1, np.int64)
+        self.deferred_vote = np.full(shape, -1, np.int64)
+        self.learned_at = np.full(shape, np.nan)
+        # Joining, and the first `/get_votes`
+        self.requests = np.full(shape, 2, np.int64)
+        self.settled = np.zeros(num_pools, bool)
+
+    def close_rounds(self, rows, now):
+        # See `ConsensusPool.close_round()`
+        self.round[rows] += 1
+        self.round_deadline[rows] = now + self.args.round_duration
+        self.live_members[rows] = self.round_voters[rows]
+        self.round_voters[rows] = 0
+        self.version[rows] += 1
+
+    def close_rounds_if_due(self, rows, now):
+        due = np.isnan(self.decided_at[rows]) & (now >= self.round_deadline[rows])
+        self.close_rounds(rows[due], now[due])
+        return due
+
+    def reply(self, rows, cols, now, backoff = None):
+        # The member gets the pool state as of `now`, and goes on like
+        # `Client.handle_pool_state()` and `Client.loop()` would
+        self.poll_timeout[rows, cols] = np.inf
+        self.seen_version[rows, cols] = self.version[rows]
+        self.seen_round[rows, cols] = self.round[rows]
+        decided = ~np.isnan(self.decided_at[rows])
+        self.learned_at[rows[decided], cols[decided]] = now[decided] + self.args.latency
+        self.next_request[rows[decided], cols[decided]] = np.inf
+        rows, cols, now = rows[~decided], cols[~decided], now[~decided]
+        if backoff is not None:
+            now = now + backoff[~decided]
+        can_vote = (self.deferred_vote[rows, cols] >= 0) | (self.voted_round[rows, cols] < self.round[rows])
+        self.posting[rows, cols] = can_vote
+        self.next_request[rows, cols] = now + 2 * self.args.latency
+        self.requests[rows, cols] += 1
+
+    def wake_waiters(self, rows, now):
+        # Held long polls get the new state, see `ConsensusPool.notify_changed()`
+        waiting = np.isfinite(self.poll_timeout[rows])
+        pool_index, cols = np.nonzero(waiting)
+        self.reply(rows[pool_index], cols, now[pool_index])
+
+    def handle_polls(self, rows, cols, now):
+        # See `ConsensusPool.get_votes()`, members without any Etag get a reply right away
+        changed = self.seen_version[rows, cols] != self.version[rows]
+        self.reply(rows[changed], cols[changed], now[changed])
+        rows, cols, now = rows[~changed], cols[~changed], now[~changed]
+        self.poll_timeout[rows, cols] = now + self.poll_seconds
+        self.next_request[rows, cols] = np.inf
+
+    def handle_votes(self, rows, cols, now):
+        # See `ConsensusPool.compare_and_set_vote()` and `Client.post_vote()`
+        deferred = self.deferred_vote[rows, cols]
+        vote = np.where(deferred >= 0, deferred, self.rng.integers(self.args.vote_range, size = len(rows)))
+        accepted = self.seen_version[rows, cols] == self.version[rows]
+        rejected = ~accepted
+        self.deferred_vote[rows[rejected], cols[rejected]] = vote[rejected]
+        backoff = self.args.backoff_scale * self.rng.weibull(self.args.backoff_shape, size = rejected.sum())
+        self.reply(rows[rejected], cols[rejected], now[rejected], backoff)
+        rows, cols, now, vote = rows[accepted], cols[accepted], now[accepted], vote[accepted]
+        self.votes[rows, cols] = vote
+        self.version[rows] += 1
+        self.round_voters[rows] |= np.left_shift(1, cols)
+        self.deferred_vote[rows, cols] = -1
+        self.voted_round[rows, cols] = self.seen_round[rows, cols]
+        # Only the number just voted for may have reached the minimum agreement
+        agreeing = (self.votes[rows] == vote[:, None]).sum(axis = 1)
+        decided = np.isnan(self.decided_at[rows]) & (agreeing >= self.args.min_agree)
+        self.decided_at[rows[decided]] = now[decided]
+        self.decided_round[rows[decided]] = self.round[rows[decided]]
+        # See `ConsensusPool.round_complete()`
+        voters = self.round_voters[rows]
+        live_members = np.where(self.live_members[rows] != 0, self.live_members[rows], self.all_members)
+        complete = (
+            np.isnan(self.decided_at[rows])
+            & (np.bitwise_count(voters) >= self.args.min_agree)
+            & (voters & live_members == live_members)
+        )
+        self.close_rounds(rows[complete], now[complete])
+        self.wake_waiters(rows, now)
+        self.reply(rows, cols, now)
+
+    def step(self):
+        rows = np.flatnonzero(~self.settled)
+        num_members = self.args.pool_size
+        # Rounds only end at their deadline if somebody waits for it to
+        # happen, otherwise the next request to come in closes them
+        waiting = np.isfinite(self.poll_timeout[rows]).any(axis = 1) & np.isnan(self.decided_at[rows])
+        deadlines = np.where(waiting, self.round_deadline[rows], np.inf)
+        times = np.concatenate([self.next_request[rows], self.poll_timeout[rows], deadlines[:, None]], axis = 1)
+        event = times.argmin(axis = 1)
+        now = times[np.arange(len(rows)), event]
+        # Pools where every member knows the decision have nothing left to do,
+        # and those which took too long are given up on
+        done = now > MAX_SIMULATED_SECONDS
+        self.settled[rows[done]] = True
+        rows, event, now = rows[~done], event[~done], now[~done]
+
+        is_deadline = event == 2 * num_members
+        self.close_rounds(rows[is_deadline], now[is_deadline])
+        self.wake_waiters(rows[is_deadline], now[is_deadline])
+
+        # Timed out long polls get a 304, and members just poll again
+        is_timeout = (event >= num_members) & ~is_deadline
+        timeout_rows, timeout_cols = rows[is_timeout], event[is_timeout] - num_members
+        self.poll_timeout[timeout_rows, timeout_cols] = np.inf
+        self.next_request[timeout_rows, timeout_cols] = now[is_timeout] + 2 * self.args.latency
+        self.requests[timeout_rows, timeout_cols] += 1
+
+        is_request = event < num_members
+        rows, cols, now = rows[is_request], event[is_request], now[is_request]
+        due = self.close_rounds_if_due(rows, now)
+        self.wake_waiters(rows[due], now[due])
+        posting = self.posting[rows, cols]
+        self.handle_votes(rows[posting], cols[posting], now[posting])
+        self.handle_polls(rows[~posting], cols[~posting], now[~posting])
+        return len(rows) > 0 or is_deadline.any() or is_timeout.any()
+
+    def run(self):
+        while self.step():
+            pass
+        decided = ~np.isnan(self.decided_at)
+        return {
+            "decided": decided,
+            "rounds": self.decided_round[decided] + 1,
+            "requests_per_member": self.requests[decided].mean(axis = 1),
+            "seconds_to_consensus": self.decided_at[decided],
+            "seconds_until_all_know": self.learned_at[decided].max(axis = 1),
+        }
+
+################################
+#          REPORTING           #
+################################
+
+def summarize(values):
+    if len(values) == 0:
+        return {"mean": math.nan, **{"p%g"%pct: math.nan for pct in REPORT_PERCENTILES}, "max": math.nan}
+    return {
+        "mean": float(values.mean()),
+        **{"p%g"%pct: float(value) for pct, value in zip(REPORT_PERCENTILES, np.percentile(values, REPORT_PERCENTILES))},
+        "max": float(values.max()),
+    }
+
+def simulate(args):
+    rng = np.random.default_rng(args.seed)
+    results = []
+    for start in range(0, args.pools, BATCH_NUM_POOLS):
+        results.append(SimulatedPools(min(BATCH_NUM_POOLS, args.pools - start), args, rng).run())
+        print(f"Simulated {start + len(results[-1]['decided'])} pools...", file = sys.stderr)
+    merged = {key: np.concatenate([result[key] for result in results]) for key in results[0]}
+    return {
+        "pools": args.pools,
+        "decided": int(merged["decided"].sum()),
+        **{key: summarize(merged[key]) for key in merged if key != "decided"},
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Simulate consensus pools offline, to see how parameters affect convergence")
+    parser.add_argument("-n", "--pools", type = int, default = DEFAULT_NUM_POOLS, help = "number of pools to simulate")
+    parser.add_argument("--pool-size", type = int, default = server.CONSENSUS_POOL_SIZE, help = "members per pool")
+    parser.add_argument("--min-agree", type = int, help = "votes needed for consensus, by default as `cf_get_min_agree()`")
+    parser.add_argument("--vote-range", type = int, default = DEFAULT_VOTE_RANGE, help = "numbers voted for are drawn below this")
+    parser.add_argument("--backoff-scale", type = float, default = DEFAULT_BACKOFF_SCALE, help = "scale of the backoff after rejected votes")
+    parser.add_argument("--backoff-shape", type = float, default = DEFAULT_BACKOFF_SHAPE, help = "shape of the backoff after rejected votes")
+    parser.add_argument("--round-duration", type = float, default = server.ROUND_DURATION_SECONDS, help = "seconds before rounds end anyway")
+    parser.add_argument("--latency", type = float, default = DEFAULT_LATENCY_SECONDS, help = "one-way network latency in seconds")
+    parser.add_argument("--join-spread", type = float, default = DEFAULT_JOIN_SPREAD_SECONDS, help = "seconds over which members show up")
+    parser.add_argument("--seed", type = int, help = "random seed, for reproducible runs")
+    parser.add_argument("-o", "--output", help = "file to write the JSON results to, instead of stdout")
+    args = parser.parse_args()
+    if not 1 <= args.pool_size <= 62:
+        parser.error("pool size must be between 1 and 62")
+    if args.min_agree is None:
+        server.CONSENSUS_POOL_SIZE = args.pool_size
+        args.min_agree = server.cf_get_min_agree()
+    init_time = time.perf_counter()
+    report = {
+        "pool_size": args.pool_size,
+        "min_agree": args.min_agree,
+        "vote_range": args.vote_range,
+        "backoff_scale": args.backoff_scale,
+        "backoff_shape": args.backoff_shape,
+        "round_duration_seconds": args.round_duration,
+        "latency_seconds": args.latency,
+        **simulate(args),
+    }
+    print(f"Simulated {args.pools} pools in {time.perf_counter() - init_time:.1f} s, {report['decided']} decided", file = sys.stderr)
+    if args.output is None:
+        json.dump(report, sys.stdout, indent = 2)
+        print()
+    else:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent = 2)
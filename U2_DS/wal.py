@@ -0,0 +1,184 @@
+import json
+import os
+import threading
+import time
+
+################################
+#       WRITE-AHEAD  LOG       #
+################################
+
+# Changes are appended to numbered log segments as JSON lines. Writers
+# do not sync the log themselves: a background thread writes whatever
+# got appended since its last round and syncs it with a single fsync,
+# so every change waiting during that fsync shares the next one (group
+# commit). Writers then wait until their record is durable.
+#
+# From time to time, the log moves on to a new segment and a snapshot
+# of the whole state is written by another thread, so that syncing goes
+# on meanwhile. As the state keeps changing while the snapshot is taken,
+# it may already include some changes of the new segment, so replaying
+# records must be idempotent. Once the snapshot is safely on disk, older
+# segments are no longer needed.
+#
+# Should writing or syncing the log ever fail, nothing logged from then
+# on can become durable, so every waiter gets a `WriteAheadLogError`.
+
+SNAPSHOT_FILE_NAME = "snapshot.json"
+
+class WriteAheadLogError(Exception):
+    pass
+
+def segment_file_name(segment):
+    return "wal-%08d.log"%segment
+
+def list_segments(directory):
+    segments = []
+    for name in os.listdir(directory):
+        if name.startswith("wal-") and name.endswith(".log"):
+            segments.append(int(name[4:-4]))
+    return sorted(segments)
+
+def fsync_directory(directory):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def read_segment(path):
+    with open(path, "rb") as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                # Torn write at the end of the log, this change never
+                # became durable so nobody was told it happened
+                return
+
+# Returns the latest snapshot (or None) and the records logged after it
+def recover(directory):
+    os.makedirs(directory, exist_ok = True)
+    snapshot = None
+    first_segment = 0
+    snapshot_path = os.path.join(directory, SNAPSHOT_FILE_NAME)
+    if os.path.exists(snapshot_path):
+        with open(snapshot_path, "rb") as f:
+            snapshot = json.load(f)
+        first_segment = snapshot["first_segment"]
+    def records():
+        for segment in list_segments(directory):
+            if segment >= first_segment:
+                yield from read_segment(os.path.join(directory, segment_file_name(segment)))
+    return snapshot, records()
+
+class WriteAheadLog:
+    def __init__(self, directory, snapshot_func, snapshot_every, commit_delay = 0):
+        self.directory = directory
+        # Returns the state to snapshot, as something JSON can encode
+        self.snapshot_func = snapshot_func
+        self.snapshot_every = snapshot_every
+        # Extra time to wait for more records before syncing them
+        self.commit_delay = commit_delay
+        self.lock = threading.Lock()
+        self.appended = threading.Condition(self.lock)
+        self.synced = threading.Condition(self.lock)
+        self.pending = []
+        self.callbacks = []
+        self.last_seq = 0
+        self.durable_seq = 0
+        self.records_since_snapshot = 0
+        self.snapshotting = False
+        self.error = None
+        # Never append to segments of a previous run, they may be torn
+        self.segment = max(list_segments(directory), default = 0) + 1
+        self.file = open(os.path.join(directory, segment_file_name(self.segment)), "ab")
+        fsync_directory(directory)
+        self.thread = threading.Thread(target = self._commit_loop, name = "WAL", daemon = True)
+        self.thread.start()
+
+    # Returns a sequence number to wait on for the record to be durable
+    def append(self, record):
+        data = (json.dumps(record, separators = (",", ":")) + "\n").encode("utf-8")
+        with self.lock:
+            self.pending.append(data)
+            self.last_seq += 1
+            self.appended.notify()
+            return self.last_seq
+
+    def wait_durable(self, seq):
+        with self.lock:
+            self.synced.wait_for(lambda : self.durable_seq >= seq or self.error is not None)
+            if self.durable_seq < seq:
+                raise WriteAheadLogError("Write-ahead log failed") from self.error
+
+    # For waiters that cannot block, the callback is run by the log thread,
+    # with the error which keeps the record from ever being durable, if any
+    def call_when_durable(self, seq, callback):
+        with self.lock:
+            if self.durable_seq < seq and self.error is None:
+                self.callbacks.append((seq, callback))
+                return
+            error = self.error if self.durable_seq < seq else None
+        callback(error)
+
+    def _sync_pending(self):
+        with self.lock:
+            self.appended.wait_for(lambda : self.pending)
+        if self.commit_delay:
+            time.sleep(self.commit_delay)
+        with self.lock:
+            pending, self.pending = self.pending, []
+            seq = self.last_seq
+        self.file.write(b"".join(pending))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        with self.lock:
+            self.durable_seq = seq
+            self.records_since_snapshot += len(pending)
+            self.synced.notify_all()
+            ready = [callback for s, callback in self.callbacks if s <= seq]
+            self.callbacks = [(s, callback) for s, callback in self.callbacks if s > seq]
+        for callback in ready:
+            callback(None)
+
+    def _start_snapshot(self):
+        # Only this thread writes to the log, so it can switch segments
+        self.file.close()
+        self.segment += 1
+        self.file = open(os.path.join(self.directory, segment_file_name(self.segment)), "ab")
+        fsync_directory(self.directory)
+        self.records_since_snapshot = 0
+        self.snapshotting = True
+        threading.Thread(target = self._write_snapshot, args = (self.segment,), name = "WAL snapshot", daemon = True).start()
+
+    def _write_snapshot(self, first_segment):
+        try:
+            snapshot = {"first_segment": first_segment, **self.snapshot_func()}
+            snapshot_path = os.path.join(self.directory, SNAPSHOT_FILE_NAME)
+            with open(snapshot_path + ".tmp", "w") as f:
+                json.dump(snapshot, f, separators = (",", ":"))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(snapshot_path + ".tmp", snapshot_path)
+            fsync_directory(self.directory)
+            for segment in list_segments(self.directory):
+                if segment < first_segment:
+                    os.remove(os.path.join(self.directory, segment_file_name(segment)))
+        finally:
+            # A failed snapshot loses nothing, the segments are still there
+            self.snapshotting = False
+
+    def _commit_loop(self):
+        try:
+            while True:
+                self._sync_pending()
+                if self.records_since_snapshot >= self.snapshot_every and not self.snapshotting:
+                    self._start_snapshot()
+        except Exception as e:
+            with self.lock:
+                self.error = e
+                self.synced.notify_all()
+                callbacks, self.callbacks = self.callbacks, []
+            for _, callback in callbacks:
+                callback(e)
+            raise
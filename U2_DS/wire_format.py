@@ -0,0 +1,76 @@
+import json
+import struct
+
+################################
+#     POOL STATE ENCODINGS     #
+################################
+
+# Besides the default JSON (with `vote_data` keyed by usernames), clients
+# may ask for pool states in one of these representations with `Accept`.
+# Members are identified by their slot in the pool, i.e. the order they
+# joined in, which `/join_pool` tells them. Only the members whose vote
+# changed since the version named by the request's `If-None-Match` (or
+# `If-Match`) are sent, so clients must merge them into what they know.
+# A base version of 0 means every member is included.
+#
+# Both representations carry the same fields:
+#
+#   {"version": <pool version>, "base_version": <version of the delta base>,
+#    "round": <voting round>, "pool_size": ..., "min_agree": ...,
+#    "members": <number of members>, "decision": <number or null>,
+#    "votes": [[<slot>, <vote>, <seq>], ...]}
+#
+# The packed one is a header followed by an entry per member, in network
+# byte order. Votes must be 32-bit integers, and missing ones are NO_VOTE.
+
+JSON_MIMETYPE = "application/json"
+COMPACT_JSON_MIMETYPE = "application/vnd.consensus-pool+json"
+PACKED_MIMETYPE = "application/vnd.consensus-pool"
+
+# In order of preference when clients accept several of them
+POOL_STATE_MIMETYPES = [JSON_MIMETYPE, COMPACT_JSON_MIMETYPE, PACKED_MIMETYPE]
+
+# Version, base version, round, pool size, min agree, members, flags, decision
+PACKED_HEADER = struct.Struct("!IIIHHHBxi")
+# Slot, vote, sequence number
+PACKED_ENTRY = struct.Struct("!HiI")
+
+PACKED_FLAG_DECIDED = 0x01
+
+NO_VOTE = -2**31
+
+def encode_compact_json(state):
+    return json.dumps(state, separators = (",", ":"))
+
+# Raises `struct.error` for votes which are not 32-bit integers
+def encode_packed(state):
+    decision = state["decision"]
+    flags = PACKED_FLAG_DECIDED if decision is not None else 0
+    parts = [PACKED_HEADER.pack(
+        state["version"], state["base_version"], state["round"], state["pool_size"], state["min_agree"],
+        state["members"], flags, decision if decision is not None else 0
+    )]
+    for slot, vote, seq in state["votes"]:
+        parts.append(PACKED_ENTRY.pack(slot, NO_VOTE if vote is None else vote, seq))
+    return b"".join(parts)
+
+def decode_packed(content):
+    version, base_version, current_round, pool_size, min_agree, members, flags, decision = PACKED_HEADER.unpack_from(content)
+    votes = []
+    for slot, vote, seq in PACKED_ENTRY.iter_unpack(content[PACKED_HEADER.size:]):
+        votes.append([slot, None if vote == NO_VOTE else vote, seq])
+    return {
+        "version": version,
+        "base_version": base_version,
+        "round": current_round,
+        "pool_size": pool_size,
+        "min_agree": min_agree,
+        "members": members,
+        "decision": decision if flags & PACKED_FLAG_DECIDED else None,
+        "votes": votes,
+    }
+
+def decode_pool_state(mimetype, content):
+    if mimetype == PACKED_MIMETYPE:
+        return decode_packed(content)
+    return json.loads(content)